@@ -0,0 +1,83 @@
+"""Self-describing checkpoint bundles for MADE and Transformer models."""
+import torch
+
+import made
+import transformer
+
+
+def SaveBundle(model, table, path, **info):
+    """Saves 'model' as a self-describing checkpoint bundle.
+
+    Besides the state dict, a bundle holds the model's constructor
+    arguments and ordering, MADE's precomputed masked weights, the table's
+    column names and domain sizes, and 'info' (e.g., model_bits, seed).
+    LoadBundle() memory-maps it back and BuildFromBundle() rebuilds the
+    model, without any flags or filename parsing.
+    """
+    masked_weights = {}
+    # With several orderings, the masks depend on the one in use.
+    if isinstance(model, made.MADE) and model.num_masks == 1:
+        masked_weights = model.masked_weights()
+    bundle = {
+        'model': type(model).__name__,
+        'config': model.config,
+        'state_dict': model.state_dict(),
+        'masked_weights': masked_weights,
+        'table': {
+            'name': table.name,
+            'num_rows': int(table.cardinality),
+            'columns': [c.name for c in table.columns],
+            'distribution_sizes': [
+                int(c.DistributionSize()) for c in table.columns
+            ],
+        },
+        'info': info,
+    }
+    if isinstance(model, transformer.Transformer):
+        bundle['mask_scheme'] = transformer.MASK_SCHEME
+    torch.save(bundle, path)
+
+
+def LoadBundle(path):
+    """Memory-maps the checkpoint at 'path'.
+
+    Returns:
+        The bundle written by SaveBundle(), or None if 'path' holds a plain
+        state dict.
+    """
+    bundle = torch.load(path, map_location='cpu', mmap=True)
+    if 'config' not in bundle or 'state_dict' not in bundle:
+        return None
+    return bundle
+
+
+def BuildFromBundle(bundle, table=None, device='cpu'):
+    """Rebuilds the model stored in 'bundle', in eval mode.
+
+    Parameters alias the memory-mapped tensors instead of being copied, so
+    processes loading the same bundle share its pages.
+
+    Args:
+        table: if given, checked to have the columns the model was trained on.
+    """
+    if table is not None:
+        assert [c.name for c in table.columns] == bundle['table']['columns'], (
+            [c.name for c in table.columns], bundle['table']['columns'])
+        assert [c.DistributionSize() for c in table.columns
+               ] == bundle['table']['distribution_sizes']
+    config = dict(bundle['config'])
+    if bundle['model'] == 'MADE':
+        config['activation'] = getattr(torch.nn, config['activation'])
+        model = made.MADE(**config)
+    else:
+        assert bundle['model'] == 'Transformer', bundle['model']
+        assert bundle['mask_scheme'] == transformer.MASK_SCHEME, (
+            bundle['mask_scheme'], transformer.MASK_SCHEME)
+        model = transformer.Transformer(**config)
+    model.load_state_dict(bundle['state_dict'], assign=True)
+    model = model.to(device)
+    for name, layer in model.named_modules():
+        if name in bundle['masked_weights']:
+            layer.masked_weight = bundle['masked_weights'][name].to(device)
+    model.eval()
+    return model
@@ -1,5 +1,11 @@
 """Data abstractions."""
 import copy
+import hashlib
+import json
+import mmap
+import multiprocessing
+import os
+import shutil
 import time
 
 import numpy as np
@@ -37,14 +43,30 @@ class Column(object):
         self.name = name
 
         # Data related fields.
-        self.data = None
+        self._data = None
+        # If set (see FillCodes()), 'data' is decoded from these when first
+        # accessed.
+        self.codes = None
         self.all_distinct_values = None
         self.distribution_size = distribution_size
+        # Built on first use by ValsToBins().
+        self._val_to_bin_index = None
 
         # pg_name is the name of the corresponding column in Postgres.  This is
         # put here since, e.g., PG disallows whitespaces in names.
         self.pg_name = pg_name if pg_name else name
 
+    @property
+    def data(self):
+        if self._data is None and self.codes is not None:
+            self._data = pd.Series(self.all_distinct_values.take(self.codes),
+                                   name=self.name)
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+
     def Name(self):
         """Name of this column."""
         return self.name
@@ -56,13 +78,60 @@ class Column(object):
         """
         return self.distribution_size
 
-    def ValToBin(self, val):
-        if isinstance(self.all_distinct_values, list):
-            return self.all_distinct_values.index(val)
-        inds = np.where(self.all_distinct_values == val)
-        assert len(inds[0]) > 0, val
+    def ValToBin(self, val, op=None):
+        return self.ValsToBins([val], op)[0]
+
+    def ValsToBins(self, vals, op=None):
+        """Maps values to their codes (bins).
+
+        In-domain values map to their codes, and nulls to the null code 0.
+        A value outside the domain has no code.  If 'op' is given, it maps
+        instead to a code that gives the same result when 'op' is applied
+        over codes as over values:
+          '<', '>=': the code of the smallest domain value above it (the
+            domain size if there is none);
+          '<=', '>': the code of the largest domain value below it (-1 if
+            there is none);
+          '=': -1, matching nothing.
+        As for in-domain values, the null code 0 then compares below every
+        other code.
+
+        Args:
+          vals: list-like values.
+          op: None, or the comparison the codes are used in.
 
-        return inds[0][0]
+        Returns:
+          An np.ndarray of np.int64 codes.
+        """
+        assert op in [None, '<', '<=', '>', '>=', '='], op
+        dvs = self.all_distinct_values
+        if isinstance(dvs, list) or dvs.dtype == object:
+            # Hash index: exact lookups don't need comparable values.
+            if self._val_to_bin_index is None:
+                self._val_to_bin_index = {v: i for i, v in enumerate(dvs)}
+            codes = [self._val_to_bin_index.get(v) for v in vals]
+            if all(c is not None for c in codes):
+                return np.asarray(codes, dtype=np.int64)
+        dvs = np.asarray(dvs)
+        vals = np.asarray(vals, dtype=object if dvs.dtype == object else None)
+        if np.issubdtype(dvs.dtype, np.datetime64):
+            vals = vals.astype(dvs.dtype)
+        isnull = pd.isnull(vals)
+        # Nulls, if any, are at position 0 and compare False to everything.
+        start = 1 if len(dvs) and pd.isnull(dvs[0]) else 0
+        left = start + np.searchsorted(dvs[start:], vals[~isnull], 'left')
+        right = start + np.searchsorted(dvs[start:], vals[~isnull], 'right')
+        absent = left == right
+        assert op is not None or not absent.any(), vals[~isnull][absent]
+        if op in ['<=', '>']:
+            found = right - 1
+        else:
+            found = left
+        if op == '=':
+            found[absent] = -1
+        codes = np.zeros(len(vals), dtype=np.int64)
+        codes[~isnull] = found
+        return codes
 
     def SetDistribution(self, distinct_values):
         """This is all the values this column will ever see."""
@@ -93,6 +162,15 @@ class Column(object):
             self.SetDistribution(self.data)
         return self
 
+    def FillCodes(self, codes):
+        """Backs this column by 'codes' into its (already set) domain.
+
+        The values are only decoded if 'data' is accessed.
+        """
+        assert self._data is None and self.codes is None
+        self.codes = codes
+        return self
+
     def __repr__(self):
         return 'Column({}, distribution_size={})'.format(
             self.name, self.distribution_size)
@@ -126,7 +204,14 @@ class Table(object):
 
     def _validate_cardinality(self, columns):
         """Checks that all the columns have same the number of rows."""
-        cards = [len(c.data) for c in columns]
+        cards = [
+            len(c.codes) if c.codes is not None else len(c.data)
+            for c in columns
+            if c.codes is not None or c.data is not None
+        ]
+        if not cards:
+            # Out-of-core (see CsvTable's chunksize): only codes are loaded.
+            cards = [len(self.codes)]
         c = np.unique(cards)
         assert len(c) == 1, c
         return c[0]
@@ -155,6 +240,9 @@ class CsvTable(Table):
                  type_casts={},
                  pg_name=None,
                  pg_cols=None,
+                 cache_dir=None,
+                 num_workers=1,
+                 chunksize=None,
                  **kwargs):
         """Accepts the same arguments as pd.read_csv().
 
@@ -168,21 +256,225 @@ class CsvTable(Table):
               this table holds in a Postgres database.
             pg_name: optional list of str, a convenient field for specifying
               what names this table's columns hold in a Postgres database.
+            cache_dir: optional str.  If set (and a filename is passed), the
+              column domains and the discretized table are cached under this
+              directory, keyed by the file's size, mtime and a sample of its
+              contents, 'cols', 'type_casts' and **kwargs.  Later loads
+              memory-map the codes instead of parsing the CSV; values are
+              only decoded if 'data' is accessed.
+            num_workers: if > 1, builds and discretizes the columns in this
+              many processes.
+            chunksize: optional int.  If set, ingests the CSV out-of-core,
+              'chunksize' rows at a time, writing the codes straight to
+              'cache_dir' (which is required).  No DataFrame is built:
+              self.data is None and the memory-mapped self.codes hold the
+              table; a Column's values are decoded only if its 'data' is
+              accessed.
             **kwargs: keyword arguments that will be pass to pd.read_csv().
         """
         self.name = name
         self.pg_name = pg_name
-
-        if isinstance(filename_or_df, str):
-            self.data = self._load(filename_or_df, cols, **kwargs)
+        # [cardinality, num cols] integer codes (see CodeDtype()), if known;
+        # see cache_dir.
+        self.codes = None
+        # If set, 'data' is decoded from the Columns' codes when first
+        # accessed (see _load_cache()).
+        self._data = None
+        self._decode_data = False
+
+        cache_path = None
+        if isinstance(filename_or_df, str) and cache_dir is not None:
+            cache_path = self._cache_path(cache_dir, filename_or_df, cols,
+                                          type_casts, kwargs)
+
+        if chunksize is not None:
+            assert cache_path is not None, \
+                'Chunked ingestion needs a filename and a cache_dir.'
+            if not os.path.isdir(cache_path):
+                self._ingest_chunked(filename_or_df, cols, type_casts,
+                                     chunksize, cache_path, **kwargs)
+            self.columns = self._load_cache(cache_path, pg_cols)
+        elif cache_path is not None and os.path.isdir(cache_path):
+            self.columns = self._load_cache(cache_path, pg_cols)
+            self._decode_data = True
         else:
-            assert (isinstance(filename_or_df, pd.DataFrame))
-            self.data = filename_or_df
+            if isinstance(filename_or_df, str):
+                self.data = self._load(filename_or_df, cols, **kwargs)
+            else:
+                assert (isinstance(filename_or_df, pd.DataFrame))
+                self.data = filename_or_df
 
-        self.columns = self._build_columns(self.data, cols, type_casts, pg_cols)
+            self.columns = self._build_columns(self.data, cols, type_casts,
+                                               pg_cols, num_workers)
+            if cache_path is not None:
+                self._save_cache(cache_path)
 
         super(CsvTable, self).__init__(name, self.columns, pg_name)
 
+    @property
+    def data(self):
+        """A pd.DataFrame of the values; decoded on first access if cached."""
+        if self._data is None and self._decode_data:
+            self._data = pd.DataFrame({c.name: c.data for c in self.columns})
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+
+    def _cache_path(self, cache_dir, filename, cols, type_casts, kwargs):
+        """Cache directory for this table's source and arguments.
+
+        Hashing the whole file would cost as much as parsing it on every
+        warm start, so the key is the file's size and mtime plus evenly
+        spaced blocks of its contents.
+        """
+        num_blocks, block_size = 16, 1 << 16
+        st = os.stat(filename)
+        h = hashlib.sha1()
+        h.update(repr((st.st_size, st.st_mtime_ns)).encode())
+        with open(filename, 'rb') as f:
+            if st.st_size <= num_blocks * block_size:
+                h.update(f.read())
+            else:
+                for i in range(num_blocks):
+                    f.seek((st.st_size - block_size) * i // (num_blocks - 1))
+                    h.update(f.read(block_size))
+        h.update(
+            repr((cols, sorted((c, str(t)) for c, t in type_casts.items()),
+                  sorted((k, repr(v)) for k, v in kwargs.items()))).encode())
+        return os.path.join(
+            cache_dir, '{}-{}'.format(os.path.basename(filename),
+                                      h.hexdigest()[:16]))
+
+    def _save_cache(self, cache_path):
+        print('Caching table to {}...'.format(cache_path), end=' ')
+        s = time.time()
+        dtype = CodeDtype([c.DistributionSize() for c in self.columns])
+        if self.codes is None:
+            self.codes = np.stack([Discretize(c) for c in self.columns],
+                                  axis=1)
+        self.codes = self.codes.astype(dtype, copy=False)
+        tmp_path = self._cache_tmp_path(cache_path)
+        np.save(os.path.join(tmp_path, 'codes.npy'), self.codes)
+        self._commit_cache(tmp_path, cache_path,
+                           [c.name for c in self.columns],
+                           [c.all_distinct_values for c in self.columns])
+        print('done, took {:.1f}s'.format(time.time() - s))
+
+    def _cache_tmp_path(self, cache_path):
+        # Write to a temporary directory, then rename: concurrent readers
+        # never see a partial cache.
+        tmp_path = '{}.tmp{}'.format(cache_path, os.getpid())
+        os.makedirs(tmp_path, exist_ok=True)
+        return tmp_path
+
+    def _commit_cache(self, tmp_path, cache_path, cols, domains):
+        """Writes the domains next to codes.npy and publishes the cache."""
+        for i, dvs in enumerate(domains):
+            np.save(os.path.join(tmp_path, 'domain{}.npy'.format(i)),
+                    dvs,
+                    allow_pickle=True)
+        with open(os.path.join(tmp_path, 'columns.json'), 'w') as f:
+            json.dump(list(cols), f)
+        try:
+            os.rename(tmp_path, cache_path)
+        except OSError:
+            # Another process cached it first.
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def _ingest_chunked(self, filename, cols, type_casts, chunksize,
+                        cache_path, **kwargs):
+        """Discretizes a CSV into the cache, 'chunksize' rows at a time.
+
+        Two passes: the first merges each chunk's sorted uniques into the
+        columns' domains; the second discretizes each chunk into a
+        memory-mapped codes.npy.
+        """
+        print('Ingesting csv in chunks...', end=' ')
+        s = time.time()
+
+        def Chunks():
+            for chunk in pd.read_csv(filename,
+                                     sep=',',
+                                     usecols=cols,
+                                     chunksize=chunksize,
+                                     **kwargs):
+                if cols is not None:
+                    chunk = chunk[cols]
+                _CastTypes(chunk, type_casts)
+                yield chunk
+
+        num_rows = 0
+        uniques = None
+        has_null = None
+        for chunk in Chunks():
+            if uniques is None:
+                cols = list(chunk.columns)
+                uniques = [None] * len(cols)
+                has_null = [False] * len(cols)
+            num_rows += len(chunk)
+            for i, c in enumerate(cols):
+                vs = chunk[c].unique()
+                is_nan = pd.isnull(vs)
+                has_null[i] |= bool(is_nan.any())
+                vs = vs[~is_nan]
+                uniques[i] = vs if uniques[i] is None else np.union1d(
+                    uniques[i], vs)
+
+        columns = []
+        for i, c in enumerate(cols):
+            dvs = uniques[i]
+            if has_null[i]:
+                # SetDistribution() moves it to the front.
+                dvs = np.append(
+                    dvs,
+                    np.datetime64('NaT')
+                    if np.issubdtype(dvs.dtype, np.datetime64) else np.nan)
+            columns.append(Column(c).SetDistribution(dvs))
+
+        tmp_path = self._cache_tmp_path(cache_path)
+        codes = np.lib.format.open_memmap(
+            os.path.join(tmp_path, 'codes.npy'),
+            mode='w+',
+            dtype=CodeDtype([col.DistributionSize() for col in columns]),
+            shape=(num_rows, len(cols)))
+        offset = 0
+        for chunk in Chunks():
+            for i, (c, col) in enumerate(zip(cols, columns)):
+                codes[offset:offset + len(chunk), i] = Discretize(col, chunk[c])
+            offset += len(chunk)
+        codes.flush()
+        del codes
+        self._commit_cache(tmp_path, cache_path, cols,
+                           [col.all_distinct_values for col in columns])
+        print('done, took {:.1f}s'.format(time.time() - s))
+
+    def _load_cache(self, cache_path, pg_cols):
+        """Rebuilds the Columns, backed by the memory-mapped codes."""
+        print('Loading cached table {}...'.format(cache_path), end=' ')
+        s = time.time()
+        with open(os.path.join(cache_path, 'columns.json')) as f:
+            cols = json.load(f)
+        # Copy-on-write: pages are shared, yet writable for torch.
+        self.codes = np.load(os.path.join(cache_path, 'codes.npy'),
+                             mmap_mode='c')
+        if pg_cols is None:
+            pg_cols = [None] * len(cols)
+        columns = []
+        for i, (c, p) in enumerate(zip(cols, pg_cols)):
+            col = Column(c, pg_name=p)
+            # Already sorted, with any null first; see SetDistribution().
+            col.all_distinct_values = np.load(os.path.join(
+                cache_path, 'domain{}.npy'.format(i)),
+                                              allow_pickle=True)
+            col.distribution_size = len(col.all_distinct_values)
+            # Codes index the domain, so decoding recovers the parsed values.
+            col.FillCodes(self.codes[:, i])
+            columns.append(col)
+        print('done, took {:.1f}s'.format(time.time() - s))
+        return columns
+
     def _load(self, filename, cols, **kwargs):
         print('Loading csv...', end=' ')
         s = time.time()
@@ -192,7 +484,7 @@ class CsvTable(Table):
         print('done, took {:.1f}s'.format(time.time() - s))
         return df
 
-    def _build_columns(self, data, cols, type_casts, pg_cols):
+    def _build_columns(self, data, cols, type_casts, pg_cols, num_workers=1):
         """Example args:
 
             cols = ['Model Year', 'Reg Valid Date', 'Reg Expiration Date']
@@ -202,16 +494,7 @@ class CsvTable(Table):
         """
         print('Parsing...', end=' ')
         s = time.time()
-        for col, typ in type_casts.items():
-            if col not in data:
-                continue
-            if typ != np.datetime64:
-                data[col] = data[col].astype(typ, copy=False)
-            else:
-                # Both infer_datetime_format and cache are critical for perf.
-                data[col] = pd.to_datetime(data[col],
-                                           infer_datetime_format=True,
-                                           cache=True)
+        _CastTypes(data, type_casts)
 
         # Discretize & create Columns.
         if cols is None:
@@ -219,20 +502,218 @@ class CsvTable(Table):
         columns = []
         if pg_cols is None:
             pg_cols = [None] * len(cols)
-        for c, p in zip(cols, pg_cols):
+        if num_workers > 1 and len(cols) > 1 and \
+                'fork' in multiprocessing.get_all_start_methods():
+            domains = self._build_domains_parallel(data, cols, num_workers)
+        else:
+            domains = None
+        for i, (c, p) in enumerate(zip(cols, pg_cols)):
             col = Column(c, pg_name=p)
             col.Fill(data[c])
 
-            # dropna=False so that if NA/NaN is present in data,
-            # all_distinct_values will capture it.
-            #
-            # For numeric: np.nan
-            # For datetime: np.datetime64('NaT')
-            col.SetDistribution(data[c].value_counts(dropna=False).index.values)
+            if domains is not None:
+                col.all_distinct_values = domains[i]
+                col.distribution_size = len(domains[i])
+            else:
+                # dropna=False so that if NA/NaN is present in data,
+                # all_distinct_values will capture it.
+                #
+                # For numeric: np.nan
+                # For datetime: np.datetime64('NaT')
+                col.SetDistribution(
+                    data[c].value_counts(dropna=False).index.values)
             columns.append(col)
         print('done, took {:.1f}s'.format(time.time() - s))
         return columns
 
+    def _build_domains_parallel(self, data, cols, num_workers):
+        """Builds the columns' domains and codes in a process pool.
+
+        Workers are forked, so they read 'data' without copying it.  Each
+        discretizes its column straight into its row of a shared [num cols,
+        cardinality] code matrix, whose transpose becomes self.codes.
+
+        Returns:
+          A list of each column's all_distinct_values.
+        """
+        global _build_data, _build_codes
+        shape = (len(cols), len(data))
+        # Anonymous shared mapping: the forked workers' writes are visible
+        # here.
+        buf = mmap.mmap(-1, max(1, int(np.prod(shape)) * 4))
+        try:
+            _build_data = data
+            _build_codes = np.frombuffer(buf, dtype=np.int32,
+                                         count=int(np.prod(shape))).reshape(
+                                             shape)
+            ctx = multiprocessing.get_context('fork')
+            with ctx.Pool(min(num_workers, len(cols))) as pool:
+                domains = pool.map(_BuildColumn, list(enumerate(cols)))
+            self.codes = np.ascontiguousarray(_build_codes.T)
+        finally:
+            _build_data = _build_codes = None
+            buf.close()
+        return domains
+
+
+def _CastTypes(data, type_casts):
+    """Applies CsvTable's 'type_casts' to DataFrame 'data' in place."""
+    for col, typ in type_casts.items():
+        if col not in data:
+            continue
+        if typ != np.datetime64:
+            data[col] = data[col].astype(typ, copy=False)
+        else:
+            # Both infer_datetime_format and cache are critical for perf.
+            data[col] = pd.to_datetime(data[col],
+                                       infer_datetime_format=True,
+                                       cache=True)
+
+
+# Inherited by the forked workers of CsvTable._build_domains_parallel().
+_build_data = None
+_build_codes = None
+
+
+def _BuildColumn(args):
+    """Pool worker: a column's domain; writes its codes to shared memory."""
+    i, c = args
+    col = Column(c)
+    col.SetDistribution(_build_data[c].value_counts(dropna=False).index.values)
+    _build_codes[i] = Discretize(col, _build_data[c])
+    return col.all_distinct_values
+
+
+class ColumnarTable(Table):
+    """A Table stored in the columnar format written by SaveColumnar().
+
+    The format is a directory holding 'header.json' (table name, row count,
+    and each column's name, value dtype and domain size) and, for the i-th
+    column, its sorted domain 'i.dict.npy' and its codes 'i.codes.npy' in
+    the narrowest dtype.  Codes are memory-mapped and values decoded only
+    on access, so loading time scales with the domains, not the rows.
+
+    A table written with SaveColumnar(..., codes=False) holds metadata only
+    (e.g., the artifact saved next to each checkpoint; see MetadataPath()):
+    its 'data' and 'codes' are None, which is all ProgressiveSampling needs.
+    """
+
+    def __init__(self, path, cols=None, pg_name=None):
+        """Loads the table under directory 'path'.
+
+        Args:
+            cols: optional list of column names to load, in this order;
+              defaults to all.
+        """
+        print('Loading columnar table {}...'.format(path), end=' ')
+        s = time.time()
+        with open(os.path.join(path, 'header.json')) as f:
+            header = json.load(f)
+        names = [c['name'] for c in header['columns']]
+        self.has_codes = header.get('codes', True)
+        self.num_rows = header['num_rows']
+        # Extra entries passed to SaveColumnar(), e.g., model encodings.
+        self.info = header.get('info', {})
+        if cols is None:
+            cols = names
+        columns = []
+        for c in cols:
+            i = names.index(c)
+            col = Column(c)
+            # Already sorted, with any null first; see SetDistribution().
+            col.all_distinct_values = np.load(os.path.join(
+                path, '{}.dict.npy'.format(i)),
+                                              allow_pickle=True)
+            col.distribution_size = len(col.all_distinct_values)
+            assert col.distribution_size == header['columns'][i][
+                'distribution_size'], (c, col.distribution_size)
+            if self.has_codes:
+                col.FillCodes(
+                    np.load(os.path.join(path, '{}.codes.npy'.format(i)),
+                            mmap_mode='r'))
+            columns.append(col)
+        self._data = None
+        self._codes = None
+        super(ColumnarTable, self).__init__(header['name'], columns, pg_name)
+        assert self.cardinality == header['num_rows'], (self.cardinality,
+                                                        header['num_rows'])
+        print('done, took {:.1f}s'.format(time.time() - s))
+
+    def _validate_cardinality(self, columns):
+        if not self.has_codes:
+            return self.num_rows
+        return super(ColumnarTable, self)._validate_cardinality(columns)
+
+    @property
+    def data(self):
+        """A pd.DataFrame of the values, decoded on first access."""
+        if self._data is None and self.has_codes:
+            self._data = pd.DataFrame({c.name: c.data for c in self.columns})
+        return self._data
+
+    @property
+    def codes(self):
+        """[cardinality, num cols] codes, stacked on first access."""
+        if self._codes is None and self.has_codes:
+            dtype = CodeDtype([c.DistributionSize() for c in self.columns])
+            self._codes = np.stack(
+                [c.codes.astype(dtype, copy=False) for c in self.columns],
+                axis=1)
+        return self._codes
+
+
+def SaveColumnar(table, path, codes=True, info=None):
+    """Writes 'table' to directory 'path' in ColumnarTable's format.
+
+    Args:
+        codes: if False, writes only the metadata (names, domains, row count)
+          and skips the per-row codes.
+        info: optional JSON-serializable dict stored in the header and
+          exposed as ColumnarTable.info.
+    """
+    print('Writing columnar table {}...'.format(path), end=' ')
+    s = time.time()
+    os.makedirs(path, exist_ok=True)
+    header = {
+        'name': table.name,
+        'num_rows': int(table.cardinality),
+        'codes': codes,
+    }
+    if info is not None:
+        header['info'] = info
+    header['columns'] = []
+    table_codes = getattr(table, 'codes', None) if codes else None
+    for i, col in enumerate(table.columns):
+        if codes:
+            col_codes = Discretize(
+                col) if table_codes is None else table_codes[:, i]
+            np.save(
+                os.path.join(path, '{}.codes.npy'.format(i)),
+                np.ascontiguousarray(col_codes,
+                                     dtype=CodeDtype([col.DistributionSize()
+                                                     ])))
+        np.save(os.path.join(path, '{}.dict.npy'.format(i)),
+                col.all_distinct_values,
+                allow_pickle=True)
+        header['columns'].append({
+            'name': col.name,
+            'dtype': str(col.all_distinct_values.dtype),
+            'distribution_size': int(col.DistributionSize()),
+        })
+    with open(os.path.join(path, 'header.json'), 'w') as f:
+        json.dump(header, f, indent=2)
+    print('done, took {:.1f}s'.format(time.time() - s))
+
+
+def MetadataPath(ckpt_path):
+    """Path of the table metadata saved next to checkpoint 'ckpt_path'.
+
+    The directory is in ColumnarTable's format without codes, so
+    ColumnarTable(MetadataPath(ckpt_path)) is enough to build a
+    ProgressiveSampling estimator without the base table.
+    """
+    return os.path.splitext(ckpt_path)[0] + '.table'
+
 
 class TableDataset(data.Dataset):
     """Wraps a Table and yields each row as a PyTorch Dataset element."""
@@ -244,11 +725,18 @@ class TableDataset(data.Dataset):
 
         print('Discretizing table...', end=' ')
         s = time.time()
-        # [cardinality, num cols].
-        self.tuples_np = np.stack(
-            [self.Discretize(c) for c in self.table.Columns()], axis=1)
-        self.tuples = torch.as_tensor(
-            self.tuples_np.astype(np.float32, copy=False))
+        # [cardinality, num cols], in the narrowest dtype that fits.
+        dtype = CodeDtype([c.DistributionSize() for c in self.table.Columns()])
+        if getattr(self.table, 'codes', None) is not None:
+            # Discretized (or cached) already.
+            self.tuples_np = self.table.codes.astype(dtype, copy=False)
+        else:
+            self.tuples_np = np.stack([
+                self.Discretize(c).astype(dtype, copy=False)
+                for c in self.table.Columns()
+            ], axis=1)
+        # Shares memory with tuples_np.
+        self.tuples = torch.from_numpy(self.tuples_np)
         print('done, took {:.1f}s'.format(time.time() - s))
 
     def Discretize(self, col):
@@ -271,6 +759,18 @@ class TableDataset(data.Dataset):
         return self.tuples[idx]
 
 
+def CodeDtype(distribution_sizes):
+    """Narrowest integer dtype holding the codes of all these domains.
+
+    Sticks to dtypes torch.from_numpy() supports (e.g., no uint16).
+    """
+    max_code = max(distribution_sizes) - 1
+    for dtype in [np.uint8, np.int16, np.int32]:
+        if max_code <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
 def Discretize(col, data=None):
     """Transforms data values into integers using a Column's vocab.
 
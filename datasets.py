@@ -1,4 +1,5 @@
 """Dataset registrations."""
+import argparse
 import os
 
 import numpy as np
@@ -6,7 +7,10 @@ import numpy as np
 import common
 
 
-def LoadDmv(filename='dmv.csv'):
+def LoadDmv(filename='dmv.csv',
+            cache_dir=None,
+            num_workers=1,
+            chunksize=None):
     csv_file = './datasets/{}'.format(filename)
     cols = [
         'Record Type', 'State', 'County', 'Body Type',
@@ -17,10 +21,49 @@ def LoadDmv(filename='dmv.csv'):
     # don't need to specify a type-cast for those because the desired order
     # there is the same as the default str-ordering (lexicographical).
     type_casts = {'Reg Valid Date': np.datetime64}
-    return common.CsvTable('DMV', csv_file, cols, type_casts)
+    return common.CsvTable('DMV',
+                           csv_file,
+                           cols,
+                           type_casts,
+                           cache_dir=cache_dir,
+                           num_workers=num_workers,
+                           chunksize=chunksize)
 
 
-def LoadMyDataset(filename, cols):
+def LoadMyDataset(filename,
+                  cols,
+                  cache_dir=None,
+                  num_workers=1,
+                  chunksize=None):
     # Make sure that this loads data correctly.
     csv_file = './datasets/{}'.format(filename)
-    return common.CsvTable('TPCDS', csv_file, cols)
+    return common.CsvTable('TPCDS',
+                           csv_file,
+                           cols,
+                           cache_dir=cache_dir,
+                           num_workers=num_workers,
+                           chunksize=chunksize)
+
+
+def LoadColumnar(dirname, cols=None):
+    """Loads a table converted by running this file (see below)."""
+    return common.ColumnarTable('./datasets/{}'.format(dirname), cols)
+
+
+if __name__ == '__main__':
+    # One-time conversion of a CSV dataset to the columnar format, e.g.:
+    #   python datasets.py --dataset=dmv
+    #   python datasets.py --dataset=ss.csv --col ss_sold_date_sk ss_quantity
+    # writes ./datasets/dmv.cols (ss.cols), to load with --dataset=dmv.cols.
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', type=str, required=True)
+    parser.add_argument('--col', nargs='+', default=None)
+    args = parser.parse_args()
+    if args.dataset == 'dmv-tiny':
+        table = LoadDmv('dmv-tiny.csv')
+    elif args.dataset == 'dmv':
+        table = LoadDmv()
+    else:
+        table = LoadMyDataset(args.dataset, args.col)
+    common.SaveColumnar(
+        table, './datasets/{}.cols'.format(os.path.splitext(args.dataset)[0]))
@@ -5,9 +5,9 @@ be found in 'ProgressiveSampling'.
 """
 import bisect
 import collections
-import copy
 import json
 import operator
+import statistics
 import time
 
 import numpy as np
@@ -26,6 +26,120 @@ OPS = {
     '=': np.equal
 }
 
+class AggEstimate(
+        collections.namedtuple(
+            'AggEstimate',
+            ['avg', 'count', 'sum', 'avg_var', 'count_var', 'sum_var',
+             'truncated'],
+            defaults=[False])):
+    """AVG/COUNT/SUM estimates drawn from one set of samples, with the
+    variance of each estimator.  'truncated' is set if a deadline cut the
+    sampling short (see ProgressiveSampling.Query())."""
+    __slots__ = ()
+
+    def Interval(self, field, confidence=0.95):
+        """Normal-approximation confidence interval of an estimate.
+
+        Args:
+          field: 'avg', 'count' or 'sum'.
+
+        Returns:
+          (lo, hi), floats or arrays like the estimate.
+        """
+        z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2)
+        est = getattr(self, field)
+        half = z * np.sqrt(getattr(self, field + '_var'))
+        return est - half, est + half
+
+
+def _ExpandRows(t, num_rows):
+    """Repeats each row of 't' so it covers 'num_rows' contiguous rows."""
+    if t.shape[0] == num_rows:
+        return t
+    return t.repeat_interleave(num_rows // t.shape[0], dim=0)
+
+
+def _CodeInterval(column, op, val):
+    """Codes of 'column' satisfying '<column> op val', as [lo, hi).
+
+    Since all_distinct_values is sorted (with any null first), each OPS
+    predicate selects a contiguous range of codes.  Returns None if the
+    domain can't be searched (e.g., is a list, or isn't comparable to 'val').
+    """
+    vs = column.all_distinct_values
+    if not isinstance(vs, np.ndarray):
+        return None
+    if pd.isnull(val):
+        # Null compares False to everything.
+        return 0, 0
+    # Null never satisfies a predicate.
+    start = 1 if len(vs) and pd.isnull(vs[0]) else 0
+    try:
+        left = start + np.searchsorted(vs[start:], val, side='left')
+        right = start + np.searchsorted(vs[start:], val, side='right')
+    except (TypeError, ValueError):
+        return None
+    return {
+        '>': (right, len(vs)),
+        '<': (start, left),
+        '>=': (left, len(vs)),
+        '<=': (start, right),
+        '=': (left, right),
+    }[op]
+
+
+def _ApplyMask(probs, valid):
+    """Multiplies [bs, dom size] 'probs' by a per-block valid mask.
+
+    'valid' is None, a [dom size] mask, or a [num groups, dom size] mask whose
+    g-th row covers the g-th of 'num groups' contiguous blocks of rows.
+    """
+    if valid is None:
+        return probs
+    if valid.dim() == 1 or probs.shape[0] in (1, valid.shape[0]):
+        return probs * valid
+    num_groups = valid.shape[0]
+    return (probs.view(num_groups, -1, probs.shape[1]) *
+            valid.unsqueeze(1)).view(probs.shape)
+
+
+def _MaskedCdf(logits, valid):
+    """Fused softmax, valid mask and CDF of [bs, dom size] 'logits'.
+
+    Returns:
+      cdf: [bs, dom size] cumulative masked mass, in units of each row's
+        largest exp(logit), i.e., unnormalized.
+      mass: [bs], the softmax mass on the valid codes.
+    """
+    e = (logits - logits.max(1, keepdim=True)[0]).exp_()
+    z = e.sum(1)
+    cdf = _ApplyMask(e, valid).cumsum(1)
+    return cdf, cdf[:, -1] / z
+
+
+def _InverseCdf(cdf, u):
+    """Draws codes from each row of an unnormalized CDF at uniforms 'u'.
+
+    Args:
+      cdf: [bs, dom size] cumulative masses.
+      u: [bs, num] uniforms in [0, 1).
+
+    Returns:
+      [bs, num] codes: the first code whose cumulative mass exceeds u (the
+      last one, if the row has no mass).
+    """
+    codes = torch.searchsorted(cdf, (u * cdf[:, -1:]).contiguous(), right=True)
+    return codes.clamp_(max=cdf.shape[1] - 1)
+
+
+def _ExpectedRank(cdf):
+    """[bs] expected 1-based rank of a code drawn from each row of 'cdf'.
+
+    By summation by parts, sum_k (k + 1) p_k = (n + 1) C - sum_k C_k, where
+    C_k are the cumulative masses and C = C_{n-1} their total.
+    """
+    return cdf.shape[1] + 1 - cdf.sum(1) / cdf[:, -1].clamp(min=1e-30)
+
 
 class CardEst(object):
     """Base class for a cardinality estimator."""
@@ -185,13 +299,32 @@ class ProgressiveSampling(CardEst):
             device=None,
             seed=False,
             cardinality=None,
-            shortcircuit=False  # Skip sampling on wildcards?
-    ):
+            shortcircuit=False,  # Skip sampling on wildcards?
+            group_discovery=False,  # Find GROUP BY groups by sampling?
+            group_min_mass=0.,
+            group_top_k=None,
+            group_allocation='even',
+            mask_cache_size=256,
+            rel_ci_width=None,
+            max_samples=None,
+            confidence=0.95,
+            exact_enumeration=True,
+            sampler='multinomial'):
         super(ProgressiveSampling, self).__init__()
         torch.set_grad_enabled(False)
         self.model = model
         self.table = table
         self.shortcircuit = shortcircuit
+        # GROUP BY: estimate only groups found by a pilot pass, with at least
+        # 'group_min_mass' of the table's rows (at most the 'group_top_k'
+        # heaviest), instead of every value combination.
+        self.group_discovery = group_discovery
+        self.group_min_mass = group_min_mass
+        self.group_top_k = group_top_k
+        # GROUP BY: 'even' splits the sample budget evenly across groups;
+        # 'adaptive' by mass and variance from a pilot pass.
+        assert group_allocation in ['even', 'adaptive'], group_allocation
+        self.group_allocation = group_allocation
 
         if r <= 1.0:
             self.r = r  # Reduction ratio.
@@ -202,10 +335,50 @@ class ProgressiveSampling(CardEst):
         self.seed = seed
         self.device = device
 
+        # Sequential sampling: if 'rel_ci_width' is set, Query() keeps
+        # drawing batches of 'r' samples until the 'confidence' intervals of
+        # AVG, COUNT and SUM are at most that wide relative to the estimates,
+        # or 'max_samples' (default: 10 batches) have been drawn.
+        self.rel_ci_width = rel_ci_width
+        self.max_samples = max_samples
+        if rel_ci_width is not None:
+            assert self.num_samples, 'Sequential sampling needs r > 1'
+            if max_samples is None:
+                self.max_samples = 10 * self.num_samples
+        self.confidence = confidence
+        # Enumerate a query's region exactly instead of sampling it when that
+        # takes fewer forward rows (see _enumeration_cost()).
+        self.exact_enumeration = exact_enumeration
+        # How sampled codes are drawn from each column's conditional:
+        #   'multinomial': independently.
+        #   'stratified': by inverse CDF at stratified uniforms.  A row shared
+        #     by a block of samples (the first column) gets one uniform per
+        #     stratum of [0, 1); draws of one sample per row (later columns)
+        #     are stratified across rows, a Latin hypercube over the columns.
+        #   'systematic': as 'stratified', with one random offset shared by
+        #     all strata.
+        #   'sobol': by inverse CDF at scrambled Sobol points, one dimension
+        #     per column, one point per sample.
+        # Each sample path is still an exact draw from the model, so the
+        # estimates stay unbiased; variances are still computed as if the
+        # samples were independent, which overstates them.
+        assert sampler in ['multinomial', 'stratified', 'systematic',
+                           'sobol'], sampler
+        assert sampler == 'multinomial' or self.num_samples, sampler
+        self.sampler = sampler
+        # Samples drawn by each Query(); 0 if enumerated.
+        self.query_num_samples = []
+        # (num samples, ms) of recent batches, to size them to a deadline.
+        self._batch_ms = collections.deque(maxlen=32)
+
         self.cardinality = cardinality
         if cardinality is None:
             self.cardinality = table.cardinality
 
+        # LRU cache of valid masks: (column name, ops, vals) -> mask.
+        self.mask_cache_size = mask_cache_size
+        self._mask_cache = collections.OrderedDict()
+
         with torch.no_grad():
             self.init_logits = self.model(
                 torch.zeros(1, self.model.nin, device=device))
@@ -219,8 +392,13 @@ class ProgressiveSampling(CardEst):
         # We can't seem to trace this because it depends on a scalar input.
         self.traced_encode_input = model.EncodeInput
 
-        if 'MADE' in str(model):
-            for layer in model.net:
+        if 'MADE' in str(model) and model.num_masks > 1:
+            # One set of masked weights per ordering, switched between (or
+            # batched over) instead of rebuilding the masks.
+            model.cache_masked_weights()
+        elif 'MADE' in str(model):
+            # Includes the direct-IO layer and those inside residual blocks.
+            for layer in model.modules():
                 if type(layer) == made.MaskedLinear:
                     if layer.masked_weight is None:
                         layer.masked_weight = layer.mask * layer.weight
@@ -230,6 +408,30 @@ class ProgressiveSampling(CardEst):
             p.requires_grad = False
         self.init_logits.detach_()
 
+        # Logits before any column is sampled, one row per ordering of a
+        # multi-mask MADE: 'init_logits' only holds those of whichever mask
+        # was active when it was computed.  See _init_logits().
+        if getattr(model, 'orderings_cached', False):
+            with torch.no_grad():
+                zeros = model.EncodeInput(
+                    torch.zeros(len(model.orderings), model.nin,
+                                device=device))
+                self.ordering_init_logits = list(
+                    model.forward_orderings(zeros).split(1))
+        else:
+            self.ordering_init_logits = [self.init_logits]
+
+        # The first sampled column's conditional never changes: precompute,
+        # per ordering, each column's softmax of its initial logits and CDF.
+        self._init_cdfs = []
+        for logits in self.ordering_init_logits:
+            cdfs = []
+            for natural_idx in range(len(self.table.columns)):
+                probs = torch.softmax(
+                    self.model.logits_for_col(natural_idx, logits), 1)
+                cdfs.append((probs, probs.cumsum(1)))
+            self._init_cdfs.append(cdfs)
+
         with torch.no_grad():
             self.kZeros = torch.zeros(self.num_samples,
                                       self.model.nin,
@@ -238,6 +440,17 @@ class ProgressiveSampling(CardEst):
 
             # For transformer, need to flatten [num cols, d_model].
             self.inp = self.inp.view(self.num_samples, -1)
+        # Grown on demand by QueryBatch().
+        self._batch_inp = None
+
+        # MADE: update the first layer with each newly sampled column's block
+        # of weights, instead of recomputing it (see MADE.init_incremental).
+        # Multiple masks would change the weights between forward passes.
+        # Transformer: cache keys/values of already sampled positions (see
+        # Transformer.init_incremental).
+        self.incremental = (isinstance(model, made.MADE) and
+                            model.num_masks == 1) or isinstance(
+                                model, transformer.Transformer)
 
     def __str__(self):
         if self.num_samples:
@@ -246,280 +459,1101 @@ class ProgressiveSampling(CardEst):
             n = int(self.r * self.table.columns[0].DistributionSize())
         return 'psample_{}'.format(n)
 
+    def _skipped(self, ordering, operators_list, sampled_cols):
+        """Which columns are skipped (unsampled) wildcards.
+
+        A column is skipped only under shortcircuit, and only if it is a
+        wildcard in every query of 'operators_list'.  The last column in the
+        ordering and 'sampled_cols' (aggregated and group-by columns) are
+        always sampled, since the estimates are read off them.
+
+        Returns:
+          A list of bools, indexed by natural column index.
+        """
+        ncols = len(operators_list[0])
+        skipped = [False] * ncols
+        if not self.shortcircuit:
+            return skipped
+        last = ncols - 1 if ordering is None else ordering[-1]
+        for natural_idx in range(ncols):
+            skipped[natural_idx] = (
+                natural_idx != last and natural_idx not in sampled_cols and
+                all(ops[natural_idx] is None for ops in operators_list))
+        return skipped
+
+    def _valid_masks(self, columns, operators, vals):
+        """Per-column valid masks of a query, or None if all valid.
+
+        Masks are built on the device from code intervals, and the most
+        recently used ones are cached; they must not be modified in place.
+        """
+        valid_i_list = [None] * len(columns)
+        for i in range(len(columns)):
+            ops = operators[i]
+            if ops is None or all(op is None for op in ops):
+                continue
+            try:
+                key = (columns[i].Name(), tuple(ops), tuple(vals[i]))
+                valid_i = self._mask_cache.get(key)
+            except TypeError:
+                # Unhashable literal.
+                key = valid_i = None
+            if valid_i is not None:
+                self._mask_cache.move_to_end(key)
+            else:
+                valid_i = self._valid_mask(columns[i], ops, vals[i])
+                if key is not None:
+                    self._mask_cache[key] = valid_i
+                    if len(self._mask_cache) > self.mask_cache_size:
+                        self._mask_cache.popitem(last=False)
+            valid_i_list[i] = valid_i
+        return valid_i_list
+
+    def _valid_mask(self, column, ops, vals):
+        """[dom size] valid mask of the conjunction of 'ops' on 'column'."""
+        lo, hi = 0, column.DistributionSize()
+        for op, val in zip(ops, vals):
+            if op is None:
+                continue
+            interval = _CodeInterval(column, op, val)
+            if interval is None:
+                break
+            lo, hi = max(lo, interval[0]), min(hi, interval[1])
+        else:
+            valid = torch.zeros(column.DistributionSize(), device=self.device)
+            valid[lo:max(lo, hi)] = 1.
+            return valid
+
+        # Fall back to evaluating the predicates over the whole domain.
+        valid_i = None
+        for op, val in zip(ops, vals):
+            if op is not None:
+                valid = OPS[op](column.all_distinct_values,
+                                val).astype(np.float32, copy=False)
+                if valid_i is not None:
+                    valid_i *= valid
+                else:
+                    valid_i = valid
+        # This line triggers a host -> gpu copy, showing up as a hotspot in
+        # cprofile.
+        return torch.as_tensor(valid_i, device=self.device)
+
+    def _input_block(self, natural_idx):
+        """The [l, r) slice of column 'natural_idx' in the input buffer.
+
+        None if the column is never fed to the model.
+        """
+        if isinstance(self.model, transformer.Transformer):
+            # Inputs are right-shifted by SOS.  Under MASK_SCHEME 0, the last
+            # column isn't fed.
+            d_model = self.model.d_model
+            if transformer.MASK_SCHEME == 0 and \
+                    natural_idx == self.model.nin - 1:
+                return None
+            return (natural_idx + 1) * d_model, (natural_idx + 2) * d_model
+        l = 0 if natural_idx == 0 else self.model.input_bins_encoded_cumsum[
+            natural_idx - 1]
+        return l, self.model.input_bins_encoded_cumsum[natural_idx]
+
+    def _fill_wildcards(self, inp, skipped):
+        """Encodes SOS (Transformer) and skipped wildcards as [MASK]."""
+        if isinstance(self.model, transformer.Transformer):
+            self.model.EncodeInput(None,
+                                   natural_col=-1,
+                                   out=inp[:, :self.model.d_model])
+        for natural_idx, skip in enumerate(skipped):
+            if not skip or self._input_block(natural_idx) is None:
+                continue
+            l, r = self._input_block(natural_idx)
+            self.model.EncodeInput(None,
+                                   natural_col=natural_idx,
+                                   out=inp[:, l:r])
+
+    def _input_buffer(self, num_rows):
+        """A zeroed input buffer with 'num_rows' rows, for QueryBatch()."""
+        if self._batch_inp is None or self._batch_inp.shape[0] < num_rows:
+            with torch.no_grad():
+                zeros = torch.zeros(num_rows,
+                                    self.model.nin,
+                                    device=self.device)
+                self._batch_inp = self.traced_encode_input(zeros).view(
+                    num_rows, -1)
+        return self._batch_inp[:num_rows].zero_()
+
+    def _init_logits(self, ordering):
+        """Logits before any column is sampled, in sampling order 'ordering'."""
+        if len(self.ordering_init_logits) == 1:
+            return self.ordering_init_logits[0]
+        # MADE orderings map natural idx -> position.
+        return self.ordering_init_logits[self.model._ordering_index(
+            np.argsort(ordering))]
+
     def _sample_n(self,
                   num_samples,
                   ordering,
                   columns,
                   operators,
                   vals,
-                  inp=None,
-                  count=None):
-        ncols = len(columns)
-        logits = self.init_logits
+                  inp=None):
+        logits = self._init_logits(ordering)
         select_col = self.table.ColumnIndex(self.agg_col)
 
         # Use the query to filter each column's domain.
-        valid_i_list = [None] * ncols  # None means all valid.
+        valid_i_list = self._valid_masks(columns, operators, vals)
+        # Fill in wildcards, if enabled.
+        skipped = self._skipped(ordering, [operators], [select_col])
+        self._fill_wildcards(inp, skipped)
 
-        for i in range(ncols):
-            # natural_idx = ordering[i]
+        return self.runModel(valid_i_list, skipped, logits, ordering, inp,
+                             select_col, num_samples)
 
-            # Column i.
-            ops = operators[i]
-            # print('ops', ops)
-            valid_i = valid_i_list[i]
-            if ops is not None:
-                for j, op in enumerate(ops):
-                    if op is not None:
-                        # There exists a filter.
-                        valid = OPS[op](columns[i].all_distinct_values,
-                                          vals[i][j]).astype(np.float32,
-                                                                    copy=False)
-                        if valid_i is not None:
-                            valid_i *= valid
-                        else:
-                            valid_i = valid
+    def _sample_orderings(self, num_samples, orderings, columns, operators,
+                          vals, inp):
+        """_sample_n() under all of a MADE's orderings at once.
+
+        The i-th ordering draws 'num_samples' samples in the i-th block of
+        rows of 'inp', and each forward pass covers all blocks in one batched
+        computation (see MADE.forward_orderings()).
+
+        Returns:
+          probs, agg: [num orderings * num samples], as in runModel().
+        """
+        select_col = self.table.ColumnIndex(self.agg_col)
+        valid_i_list = self._valid_masks(columns, operators, vals)
+        ncol = len(valid_i_list)
+        num_orderings = len(orderings)
+        inp = inp[:num_orderings * num_samples]
+        blocks = inp.view(num_orderings, num_samples, -1)
+        skipped = [
+            self._skipped(ordering, [operators], [select_col])
+            for ordering in orderings
+        ]
+        for k in range(num_orderings):
+            self._fill_wildcards(blocks[k], skipped[k])
+
+        logits = [self._init_logits(ordering) for ordering in orderings]
+        probs = [None] * num_orderings
+        ranks = torch.zeros(num_orderings, num_samples, device=self.device)
+        points = [
+            self._sobol_points(num_samples, ncol) for _ in range(num_orderings)
+        ]
+        for i in range(ncol):
+            for k, ordering in enumerate(orderings):
+                natural_idx = ordering[i]
+                if skipped[k][natural_idx]:
+                    continue
+                cdf, probs_i_summed = self._masked_cdf(
+                    natural_idx, logits[k], valid_i_list[natural_idx])
+                if probs[k] is None:
+                    probs[k] = probs_i_summed
+                else:
+                    probs[k] = _ExpandRows(probs[k], num_samples) * _ExpandRows(
+                        probs_i_summed, num_samples)
+
+                if i == ncol - 1:
+                    # Rao-Blackwellize the aggregated column if it comes last.
+                    if natural_idx == select_col:
+                        ranks[k] = _ExpandRows(_ExpectedRank(cdf),
+                                               num_samples)
+                    continue
+
+                samples_i = self._draw_codes(
+                    cdf, num_samples // cdf.shape[0],
+                    None if points[k] is None else points[k][:, i]).view(-1, 1)
+                if natural_idx == select_col:
+                    ranks[k] = samples_i.view(-1) + 1.
+                l, r = self._input_block(natural_idx)
+                self.model.EncodeInput(samples_i,
+                                       natural_col=natural_idx,
+                                       out=blocks[k][:, l:r])
+
+            if i < ncol - 1 and not all(
+                    skipped[k][ordering[i + 1]]
+                    for k, ordering in enumerate(orderings)):
+                logits = self.model.forward_orderings(inp).view(
+                    num_orderings, num_samples, -1).unbind(0)
+
+        probs = torch.cat([_ExpandRows(p, num_samples) for p in probs])
+        return probs, probs * ranks.view(-1)
+
+    def _group_grid(self, columns, valid_i_list, groupby_idx):
+        """Enumerates all groups of a GROUP BY whose values pass the filters.
+
+        Returns:
+          [num groups, len(groupby_idx)] array of codes, lexicographic order.
+        """
+        codes = []
+        for idx in groupby_idx:
+            valid = valid_i_list[idx]
+            if valid is None:
+                codes.append(np.arange(columns[idx].DistributionSize()))
             else:
-                continue
+                codes.append(np.nonzero(valid.cpu().numpy())[0])
+        return np.stack(np.meshgrid(*codes, indexing='ij'),
+                        axis=-1).reshape(-1, len(groupby_idx))
 
-            # This line triggers a host -> gpu copy, showing up as a
-            # hotspot in cprofile.
-            valid_i_list[i] = torch.as_tensor(valid_i, device=self.device)
-        # Fill in wildcards, if enabled.
-        if self.shortcircuit:
-            for i in range(ncols):
-                natural_idx = i if ordering is None else ordering[i]
-                if operators[natural_idx] is None and i != ncols - 1:
-                    if natural_idx == 0:
-                        self.model.EncodeInput(
-                            None,
-                            natural_col=0,
-                            out=inp[:, :self.model.
-                                    input_bins_encoded_cumsum[0]])
-                    else:
-                        l = self.model.input_bins_encoded_cumsum[natural_idx -
-                                                                 1]
-                        r = self.model.input_bins_encoded_cumsum[natural_idx]
-                        self.model.EncodeInput(None,
-                                               natural_col=natural_idx,
-                                               out=inp[:, l:r])
+    def _discover_groups(self, ordering, operators, valid_i_list, select_col,
+                         groupby_idx):
+        """Finds the groups of a GROUP BY that the model puts mass on.
 
+        Draws a pilot set of progressive samples under the query's filters,
+        with the group-by columns sampled freely, and estimates each sampled
+        group's mass (fraction of the table) from the paths that hit it.
+        Groups below 'group_min_mass' are dropped; if 'group_top_k' is set,
+        only the k heaviest are kept.
 
+        Returns:
+          [num groups, len(groupby_idx)] array of codes, lexicographic order.
+        """
+        num_samples = self.num_samples
+        skipped = self._skipped(ordering, [operators],
+                                [select_col] + groupby_idx)
+        inp = self._input_buffer(num_samples)
+        self._fill_wildcards(inp, skipped)
+        probs, _, codes = self.runModel(valid_i_list,
+                                        skipped,
+                                        self._init_logits(ordering),
+                                        ordering,
+                                        inp,
+                                        select_col,
+                                        num_samples,
+                                        return_codes=groupby_idx)
+        uniq, inverse = torch.unique(codes, dim=0, return_inverse=True)
+        mass = torch.zeros(len(uniq), dtype=probs.dtype,
+                           device=self.device).index_add_(
+                               0, inverse, probs) / num_samples
+        keep = (mass > 0) & (mass >= self.group_min_mass)
+        if self.group_top_k is not None and keep.sum() > self.group_top_k:
+            top = torch.topk(mass.masked_fill(~keep, -1.),
+                             self.group_top_k).indices
+            keep = torch.zeros_like(keep)
+            keep[top] = True
+        return uniq[keep].cpu().numpy()
+
+    def _pin_groups(self, columns, valid_i_list, groupby_idx, grid):
+        """Pins each group of 'grid' to its codes.
 
-        # Doing this convoluted scheme because m_p[0] is a scalar, and
-        # we want the correct shape to broadcast.
+        Returns:
+          values: [num groups, len(groupby_idx)] array of group values.
+          valid_i_list: a copy of 'valid_i_list' where each group-by column
+            has a [num groups, dom size] mask, one-hot on the group's code.
+        """
+        values = np.empty(grid.shape, dtype=object)
+        valid_i_list = list(valid_i_list)
+        for j, idx in enumerate(groupby_idx):
+            values[:, j] = columns[idx].all_distinct_values[grid[:, j]]
+            pinned = torch.zeros(len(grid),
+                                 columns[idx].DistributionSize(),
+                                 device=self.device)
+            pinned[torch.arange(len(grid)), torch.as_tensor(grid[:, j])] = 1.
+            valid_i_list[idx] = pinned
+        return values, valid_i_list
+
+    def _query_groups(self, orderings, columns, operators, vals, max_rows):
+        """Estimates every group of a GROUP BY in batched passes.
+
+        Groups are either all value combinations passing the filters, or,
+        with 'group_discovery', those found by a pilot pass (see
+        _discover_groups()).  The sample budget is split evenly across
+        groups, or, with group_allocation='adaptive', see _allocate().
 
-        if self.groupby_col is None:
-            result = self.runModel(valid_i_list, operators, logits,
-                                   ordering, columns, inp, select_col, num_samples, count)
-            return result
+        Returns:
+          values: [num groups, num group-by cols] array of group values.
+          probs, agg: [num samples], as in runModel().
+          groups: [num samples], the group each sample belongs to.
+        """
+        select_col = self.table.ColumnIndex(self.agg_col)
+        groupby_idx = [self.table.ColumnIndex(n) for n in self.groupby_col]
+        valid_i_list = self._valid_masks(columns, operators, vals)
+        if self.group_discovery:
+            grid = self._discover_groups(orderings[0], operators,
+                                         valid_i_list, select_col,
+                                         groupby_idx)
         else:
-            valid_list = []
-            value_list = []
-            results = []
-            values = []
-            groupby_col = [self.table.ColumnIndex(n) for n in self.groupby_col]
-            valid_list = self.generateValidList(columns, valid_i_list, 0, groupby_col, valid_list, value_list)
-            num_samples = num_samples // len(valid_list)
-            for valid_i_list, value in valid_list:
-                result = self.runModel(valid_i_list, operators, logits, ordering, columns, inp, select_col, num_samples, count)
-                if result is not None:
-                    results.append(result)
-                    values.append(value)
-            return values, results
-
-    def generateValidList(self, columns, valid_i_list, i, groupby_col, valid_list, value_list):
-        if i < len(groupby_col):
-            idx = groupby_col[i]
-            for val in columns[idx].all_distinct_values:
-                value_list = []
-                valid_i = np.equal(columns[idx].all_distinct_values,
-                                   val).astype(np.float32, copy=False)
-                valid_i_list[idx] = torch.as_tensor(valid_i, device=self.device)
-                value_list.append(val)
-                valid_list.extend(copy.deepcopy(self.generateValidList(columns, valid_i_list, i + 1, groupby_col, valid_list, value_list)))
-            return valid_list
+            grid = self._group_grid(columns, valid_i_list, groupby_idx)
+        values, valid_i_list = self._pin_groups(columns, valid_i_list,
+                                                groupby_idx, grid)
+        num_groups = len(values)
+        budget = self.num_samples // len(orderings)
+
+        def sample(counts):
+            return self._sample_groups(orderings, operators, valid_i_list,
+                                       [select_col] + groupby_idx, counts,
+                                       max_rows)
+
+        if self.group_allocation == 'adaptive' and num_groups > 1:
+            return (values,) + self._allocate(sample, budget, num_groups)
+        counts = torch.full((num_groups,),
+                            max(1, budget // max(1, num_groups)),
+                            dtype=torch.long)
+        return (values,) + sample(counts)
+
+    def _allocate(self, sample, budget, num_groups):
+        """Splits a GROUP BY's sample budget across groups by mass and spread.
+
+        A pilot pass draws a few samples per group.  Groups with no pilot
+        mass are provably empty: the softmax is positive everywhere, so a
+        pinned path only vanishes when a filter leaves no valid value.  The
+        rest of the budget goes half in proportion to each group's estimated
+        mass, and half in proportion to the pilot standard deviation of its
+        COUNT and (scaled) AVG estimators, i.e., Neyman allocation.
+
+        Returns:
+          probs, agg, groups: pilot and follow-up samples, as in
+            _query_groups().
+        """
+        pilot = max(2, budget // 4 // num_groups)
+        probs, agg, groups = sample(
+            torch.full((num_groups,), pilot, dtype=torch.long))
+        est = self._aggregate(probs, agg, groups, num_groups, raw=True)
+        mass = est.count
+        spread = (est.count_var + est.avg_var *
+                  (mass / est.avg.clamp(min=1e-30))**2).sqrt()
+        spread = spread.masked_fill(mass <= 0, 0.)
+
+        remaining = max(0, budget - pilot * num_groups)
+        share = torch.zeros_like(mass)
+        if mass.sum() > 0:
+            share += 0.5 * mass / mass.sum()
+        if spread.sum() > 0:
+            share += 0.5 * spread / spread.sum()
+        counts = (remaining * share / share.sum().clamp(min=1e-30)).long()
+        if counts.sum() == 0:
+            return probs, agg, groups
+        p2, agg2, groups2 = sample(counts.cpu())
+        return (torch.cat([probs, p2]), torch.cat([agg, agg2]),
+                torch.cat([groups, groups2]))
+
+    def _sample_groups(self, orderings, operators, valid_i_list, sampled_cols,
+                       counts, max_rows):
+        """Draws 'counts[g]' progressive samples for each pinned group g.
+
+        Blocks of consecutive groups share each forward pass, in chunks of
+        at most 'max_rows' samples (or one group, if larger).  Each ordering
+        draws 'counts' samples.
+
+        Returns:
+          probs, agg: [num samples], as in runModel().
+          groups: [num samples], the group each sample belongs to.
+        """
+        select_col = sampled_cols[0]
+        counts = counts.numpy()
+        ends = np.cumsum(counts)
+        ps, aggs, groups = [], [], []
+        for ordering in orderings:
+            skipped = self._skipped(ordering, [operators], sampled_cols)
+            lo = 0
+            while lo < len(counts):
+                start = ends[lo] - counts[lo]
+                hi = max(lo + 1,
+                         np.searchsorted(ends, start + max_rows, 'right'))
+                num_rows = int(ends[hi - 1] - start)
+                if num_rows == 0:
+                    lo = hi
+                    continue
+                block = torch.arange(lo, hi)
+                row_groups = block.repeat_interleave(
+                    torch.as_tensor(counts[lo:hi]))
+                if (counts[lo:hi] == counts[lo]).all():
+                    # Equal blocks: masks apply blockwise (see _ApplyMask).
+                    masks = [
+                        v if v is None or v.dim() == 1 else v[lo:hi]
+                        for v in valid_i_list
+                    ]
+                else:
+                    masks = [
+                        v if v is None or v.dim() == 1 else
+                        v[row_groups.to(v.device)] for v in valid_i_list
+                    ]
+                inp = self._input_buffer(num_rows)
+                self._fill_wildcards(inp, skipped)
+                p, agg = self.runModel(masks, skipped,
+                                       self._init_logits(ordering), ordering,
+                                       inp, select_col, num_rows)
+                ps.append(p)
+                aggs.append(agg)
+                groups.append(row_groups.to(p.device))
+                lo = hi
+        if not ps:
+            empty = torch.zeros(0, device=self.device)
+            return empty, empty, empty.long()
+        return torch.cat(ps), torch.cat(aggs), torch.cat(groups)
+
+    def _sobol_points(self, num_samples, ncol):
+        """[num samples, ncol] scrambled Sobol points if sampler='sobol'."""
+        if self.sampler != 'sobol':
+            return None
+        engine = torch.quasirandom.SobolEngine(
+            ncol, scramble=True, seed=int(torch.randint(2**31, ())))
+        return engine.draw(num_samples).to(self.device)
+
+    def _masked_cdf(self, natural_idx, logits, valid):
+        """_MaskedCdf() of column 'natural_idx' under 'logits'.
+
+        For initial logits, starts from the precomputed softmax and CDF.
+        """
+        for init_logits, cdfs in zip(self.ordering_init_logits,
+                                     self._init_cdfs):
+            if logits is init_logits:
+                probs, cdf = cdfs[natural_idx]
+                if valid is not None:
+                    cdf = _ApplyMask(probs, valid).cumsum(1)
+                return cdf, cdf[:, -1]
+        return _MaskedCdf(self.model.logits_for_col(natural_idx, logits),
+                          valid)
+
+    def _draw_codes(self, cdf, num_i, points_i=None):
+        """Draws 'num_i' codes from each row of 'cdf', per 'sampler'.
+
+        Args:
+          cdf: [bs, dom size] unnormalized CDFs, see _MaskedCdf().
+          points_i: with sampler='sobol', [bs * num_i] coordinates of the
+            samples' Sobol points for this column.
+
+        Returns:
+          [bs, num_i] codes.
+        """
+        bs = cdf.shape[0]
+        if self.sampler == 'multinomial':
+            u = torch.rand(bs, num_i, device=self.device)
+        elif self.sampler == 'sobol':
+            u = points_i.view(bs, num_i)
+        elif num_i > 1:
+            # Stratify each row's draws.
+            offset = torch.rand(bs,
+                                1 if self.sampler == 'systematic' else num_i,
+                                device=self.device)
+            u = (torch.arange(num_i, device=self.device) + offset) / num_i
         else:
-            return [(valid_i_list, value_list)]
+            # One draw per row: stratify across rows, in random order so
+            # that strata are independent across columns.
+            offset = torch.rand(1 if self.sampler == 'systematic' else bs,
+                                device=self.device)
+            strata = torch.randperm(bs, device=self.device)
+            u = ((strata + offset) / bs).view(bs, 1)
+        return _InverseCdf(cdf, u)
+
+    def runModel(self,
+                 valid_i_list,
+                 skipped,
+                 logits,
+                 ordering,
+                 inp,
+                 select_col,
+                 num_samples,
+                 return_codes=()):
+        """Draws one set of progressive samples.
+
+        Args:
+          valid_i_list: per-column valid masks, in natural order.  Each is
+            None (all valid), a [dom size] tensor shared by all samples, or a
+            [num groups, dom size] tensor whose g-th row applies to the g-th
+            of 'num groups' equal, contiguous blocks of samples.
+          skipped: per-column bools, see _skipped().
+          select_col: natural index of the aggregated column; either an int,
+            or a [num samples] tensor with one column per sample.
+          return_codes: natural indices of columns whose sampled codes to
+            return; these must not be skipped.
 
-    def runModel(self, valid_i_list, operators, logits, ordering, columns, inp, select_col, num_samples, count):
-        inp = self.inp[:num_samples]
-        masked_probs = []
-        ncol = len(columns)
+        Returns:
+          probs: [num samples], the probability mass each sampled path puts on
+            the query region.
+          agg: [num samples], 'probs' times the value of the aggregated column
+            along each path.  If that column is sampled last, its value is
+            replaced by its expectation under the model's conditional.
+          codes: only if 'return_codes' is non-empty, [num samples,
+            len(return_codes)] sampled codes of those columns.
+        """
+        inp = inp[:num_samples]
+        ncol = len(valid_i_list)
+        select_col = torch.as_tensor(select_col, device=self.device)
+        # Aggregates are computed over 1-based ranks of the domain, matching
+        # RealResult.
+        ranks = torch.zeros(num_samples, device=self.device)
+        probs = None
+        codes = {}
+        points = self._sobol_points(num_samples, ncol)
+        incremental = self.incremental and self.traced_fwd is None
+        if incremental:
+            # All rows start out equal: zeros, plus any encoded wildcards.
+            if isinstance(self.model, transformer.Transformer):
+                state = self.model.init_incremental(
+                    inp[:1], [c for c in range(ncol) if skipped[c]])
+            else:
+                state = self.model.init_incremental(inp[:1])
 
         # Actual progressive sampling.  Repeat:
         #   Sample next var from curr logits -> fill in next var
         #   Forward pass -> curr logits
-        # torch.set_printoptions(profile="full")
         for i in range(0, ncol):
             natural_idx = i if ordering is None else ordering[i]
+            last = i == ncol - 1
+            skip = skipped[natural_idx]
             # If wildcard enabled, 'logits' wasn't assigned last iter.
-            if not self.shortcircuit or operators[natural_idx] is not None:
-                probs_i = torch.softmax(
-                    self.model.logits_for_col(natural_idx, logits), 1)
-
-                valid_i = valid_i_list[natural_idx]
-                if valid_i is not None:
-                    probs_i *= valid_i
-
-                probs_i_summed = probs_i.sum(1)
+            if not skip:
+                # Fused softmax, mask and CDF; its mass is the valid mass.
+                cdf, probs_i_summed = self._masked_cdf(
+                    natural_idx, logits, valid_i_list[natural_idx])
 
-                masked_probs.append(probs_i_summed)
-
-                # If some paths have vanished (~0 prob), assign some nonzero
-                # mass to the whole row so that multinomial() doesn't complain.
-                paths_vanished = (probs_i_summed <= 0).view(-1, 1)
-                probs_i = probs_i.masked_fill_(paths_vanished, 1.0)
-
-            if i < ncol - 1:
-                # Num samples to draw for column i.
-                if i != 0:
-                    num_i = 1
+                if probs is None:
+                    probs = probs_i_summed
                 else:
-                    num_i = num_samples if num_samples else int(
-                        self.r * self.dom_sizes[natural_idx])
+                    probs = _ExpandRows(probs, num_samples) * _ExpandRows(
+                        probs_i_summed, num_samples)
+
+            if last:
+                # Rao-Blackwellize the aggregated column if it comes last.
+                ranks = torch.where(select_col == natural_idx,
+                                    _ExpandRows(_ExpectedRank(cdf),
+                                                num_samples), ranks)
+                if natural_idx in return_codes:
+                    codes[natural_idx] = self._draw_codes(
+                        cdf, num_samples // cdf.shape[0],
+                        None if points is None else points[:, i]).view(-1)
+                break
 
-                if self.shortcircuit and operators[natural_idx] is None:
-                    data_to_encode = None
+            if not skip:
+                # Num samples to draw for column i.  Before the first forward
+                # pass, each row of 'cdf' is shared by a block of samples.
+                # Skipped wildcards, which may come first, have no 'cdf'.
+                if num_samples:
+                    num_i = num_samples // cdf.shape[0]
                 else:
-                    samples_i = torch.multinomial(
-                        probs_i, num_samples=num_i,
-                        replacement=True)  # [bs, num_i]
-                    data_to_encode = samples_i.view(-1, 1)
-
+                    num_i = int(self.r * self.dom_sizes[natural_idx])
+
+                # Paths that have vanished (~0 prob) draw the last code; their
+                # samples carry no mass.
+                samples_i = self._draw_codes(
+                    cdf, num_i, None if points is None else
+                    points[:, i])  # [bs, num_i]
+                data_to_encode = samples_i.view(-1, 1)
+                ranks = torch.where(select_col == natural_idx,
+                                    data_to_encode.view(-1) + 1.,
+                                    ranks)
+                if natural_idx in return_codes:
+                    codes[natural_idx] = data_to_encode.view(-1)
 
                 # Encode input: i.e., put sampled vars into input buffer.
-                if data_to_encode is not None:  # Wildcards are encoded already.
-                    if not isinstance(self.model, transformer.Transformer):
-                        if natural_idx == 0:
-                            self.model.EncodeInput(
-                                data_to_encode,
-                                natural_col=0,
-                                out=inp[:, :self.model.
-                                    input_bins_encoded_cumsum[0]])
-                        else:
-                            l = self.model.input_bins_encoded_cumsum[natural_idx
-                                                                     - 1]
-                            r = self.model.input_bins_encoded_cumsum[
-                                natural_idx]
-                            self.model.EncodeInput(data_to_encode,
-                                                   natural_col=natural_idx,
-                                                   out=inp[:, l:r])
-
-                # Actual forward pass.
-                next_natural_idx = i + 1 if ordering is None else ordering[i + 1]
-                if self.shortcircuit and operators[next_natural_idx] is None and i + 1 != ncol:
-                    # If next variable in line is wildcard, then don't do
-                    # this forward pass.  Var 'logits' won't be accessed.
-                    continue
+                # Wildcards are encoded already.
+                block = self._input_block(natural_idx)
+                if block is not None:
+                    l, r = block
+                    self.model.EncodeInput(data_to_encode,
+                                           natural_col=natural_idx,
+                                           out=inp[:, l:r])
+                    if incremental:
+                        # The block was zero before, so it is the delta.
+                        self.model.update_incremental(state, inp[:, l:r],
+                                                      natural_idx)
+
+            # Actual forward pass.
+            next_natural_idx = i + 1 if ordering is None else ordering[i + 1]
+            if skipped[next_natural_idx]:
+                # If next variable in line is wildcard, then don't do
+                # this forward pass.  Var 'logits' won't be accessed.
+                continue
 
-                if hasattr(self.model, 'do_forward'):
-                    # With a specific ordering.
-                    logits = self.model.do_forward(inp, ordering)
+            if incremental:
+                logits = self.model.forward_incremental(state, next_natural_idx)
+            elif hasattr(self.model, 'do_forward'):
+                # With a specific ordering.  MADE orderings map natural idx
+                # -> position, the inverse of the sampling order.
+                logits = self.model.do_forward(
+                    inp, None if ordering is None else np.argsort(ordering))
+            else:
+                if self.traced_fwd is not None:
+                    logits = self.traced_fwd(inp)
                 else:
-                    if self.traced_fwd is not None:
-                        logits = self.traced_fwd(inp)
-                    else:
-                        logits = self.model.forward_with_encoded_input(inp)
+                    logits = self.model.forward_with_encoded_input(inp)
+
+        probs = _ExpandRows(probs, num_samples)
+        if return_codes:
+            return probs, probs * ranks, torch.stack(
+                [codes[c] for c in return_codes], 1)
+        return probs, probs * ranks
+
+    def _aggregate(self, probs, agg, groups=None, num_groups=None, raw=False):
+        """Turns per-sample outputs of runModel() into an AggEstimate.
+
+        Reduces over the last dim: [num samples] inputs give float fields,
+        [num groups, num samples] inputs give [num groups] arrays.  If
+        'groups' ([num samples] group ids) is given, samples are instead
+        reduced per group, giving [num groups] arrays.  With 'raw', fields
+        are tensors, and COUNT/SUM are fractions of the table.
+        """
+        probs, agg = torch.broadcast_tensors(probs.double(), agg.double())
+        if groups is None:
+            n = probs.shape[-1]
+            count_mean = probs.mean(-1)
+            sum_mean = agg.mean(-1)
+            nonzero = count_mean > 0
+            avg = torch.where(nonzero,
+                              sum_mean / count_mean.clamp(min=1e-300),
+                              torch.zeros_like(count_mean))
+            if n > 1:
+                count_var = probs.var(-1) / n
+                sum_var = agg.var(-1) / n
+                # Delta method for the ratio sum / count.
+                avg_var = (agg - avg.unsqueeze(-1) * probs).var(-1) / n
             else:
-                probs_i = torch.softmax(
-                    self.model.logits_for_col(natural_idx, logits), 1)
-                valid_i = valid_i_list[natural_idx]
-                if valid_i is not None:
-                    probs_i *= valid_i
-        #print(columns[select_col].all_distinct_values)
-        #vals = torch.as_tensor(columns[select_col].all_distinct_values, device=self.device)
-        #mask = ~vals.isnan()
-        #probs_i = probs_i[:, mask]
-        if self.shortcircuit and operators[select_col] is None:
-            probs_i_summed = probs_i.sum(1)
-            masked_probs.append(probs_i_summed)
-        if len(masked_probs) == 1:
-            p = masked_probs[0]
+                count_var = sum_var = avg_var = torch.zeros_like(count_mean)
         else:
-            p = masked_probs[1]
-            for ls in masked_probs[2:]:
-                p *= ls
-
-            p *= masked_probs[0]
-
-        if count:
-            count_est_value = len(self.table.data) * p.mean().item()
-            return count_est_value
-        else:
-            #vals = vals[mask]
-            #prob_select = torch.div(probs_i, probs_i.sum(1).reshape(-1, 1))
-            p_selects = probs_i.mean(dim=0)
-            # avg_est_value = torch.dot(p_selects, vals.float()).cpu().detach().numpy().item()
-            #if np.isnan(columns[select_col].all_distinct_values).any():
-            #    vals_idx = torch.from_numpy(np.arange(0, len(columns[select_col].all_distinct_values))).float().to(self.device)
-            #else:
-            vals_idx = torch.from_numpy(np.arange(1, len(columns[select_col].all_distinct_values)+1)).float().to(self.device)
-            #print(columns[select_col].all_distinct_values)
-            #print(vals_idx)
-            #print(p_selects)
-            avg_est_value = torch.dot(p_selects, vals_idx).cpu().detach().numpy().item()
-            return avg_est_value
-
-
-    def Query(self, agg_col, columns, operators, vals, groupby_col, count=True):
-        self.agg_col = agg_col
-        self.groupby_col = groupby_col
-        # Massages queries into natural order.
-        columns, operators, vals = FillInUnqueriedColumns(
-            self.table, columns, operators, vals)
-
+            # Per-group moments, for groups with unequal numbers of samples.
+            def seg_sum(x):
+                return torch.zeros(num_groups, dtype=x.dtype,
+                                   device=x.device).index_add_(0, groups, x)
+
+            n = seg_sum(torch.ones_like(probs))
+            count_mean = seg_sum(probs) / n.clamp(min=1)
+            sum_mean = seg_sum(agg) / n.clamp(min=1)
+            nonzero = count_mean > 0
+            avg = torch.where(nonzero,
+                              sum_mean / count_mean.clamp(min=1e-300),
+                              torch.zeros_like(count_mean))
+            # Unbiased variances of the per-group sample means.
+            denom = (n * (n - 1)).clamp(min=1)
+            count_var = (seg_sum(probs**2) - n * count_mean**2) / denom
+            sum_var = (seg_sum(agg**2) - n * sum_mean**2) / denom
+            resid = agg - avg[groups] * probs
+            avg_var = (seg_sum(resid**2) - seg_sum(resid)**2 /
+                       n.clamp(min=1)) / denom
+            count_var, sum_var, avg_var = (
+                v.clamp(min=0) for v in (count_var, sum_var, avg_var))
+        # Delta method for the ratio sum / count.
+        avg_var = torch.where(nonzero,
+                              avg_var / count_mean.clamp(min=1e-300)**2,
+                              torch.zeros_like(avg_var))
+        if raw:
+            return AggEstimate(avg=avg,
+                               count=count_mean,
+                               sum=sum_mean,
+                               avg_var=avg_var,
+                               count_var=count_var,
+                               sum_var=sum_var)
+
+        def _out(t):
+            return t.item() if t.dim() == 0 else t.cpu().numpy()
+
+        return AggEstimate(avg=_out(avg),
+                           count=_out(self.cardinality * count_mean),
+                           sum=_out(self.cardinality * sum_mean),
+                           avg_var=_out(avg_var),
+                           count_var=_out(self.cardinality**2 * count_var),
+                           sum_var=_out(self.cardinality**2 * sum_var))
+
+    def _sampling_orders(self, ncols):
+        """The orders (position -> natural idx) the model samples columns in."""
         # TODO: we can move these attributes to ctor.
-        ordering = None
         if hasattr(self.model, 'orderings'):
-            ordering = self.model.orderings[0]
             orderings = self.model.orderings
         elif hasattr(self.model, 'm'):
             # MADE.
-            ordering = self.model.m[-1]
             orderings = [self.model.m[-1]]
         else:
             print('****Warning: defaulting to natural order')
-            ordering = np.arange(len(columns))
-            orderings = [ordering]
+            orderings = [np.arange(ncols)]
+        if isinstance(self.model, transformer.Transformer):
+            return orderings
+        # MADE orderings map natural idx -> position; sample in the inverse
+        # order (position -> natural idx).
+        return [np.argsort(ordering) for ordering in orderings]
+
+    def Query(self,
+              agg_col,
+              columns,
+              operators,
+              vals,
+              groupby_col,
+              max_rows=2**14,
+              deadline_ms=None):
+        """Estimates AVG, COUNT and SUM of 'agg_col' from one set of samples.
+
+        Without GROUP BY, a query region small enough to enumerate in fewer
+        forward rows than sampling takes is computed exactly instead, unless
+        'exact_enumeration' is off (see _query_exact()).
 
-        num_orderings = len(orderings)
+        Args:
+          max_rows: for GROUP BY, cap on the number of samples per forward
+            pass; all groups are sampled together in chunks of this size.
+          deadline_ms: if set, a time budget for the query.  Batches are
+            sized from the recent per-sample cost to fit, and drawn while
+            time remains (up to 'max_samples', if set).  The estimate is
+            flagged 'truncated' if the deadline stopped it before its usual
+            budget of 'r' samples (or, under sequential sampling, its target
+            CI width).  Not supported with GROUP BY.
 
-        # order idx (first/second/... to be sample) -> x_{natural_idx}.
-        inv_ordering = [None] * len(columns)
-        for natural_idx in range(len(columns)):
-            inv_ordering[ordering[natural_idx]] = natural_idx
+        Returns:
+          An AggEstimate; if 'groupby_col' is specified, a pair of
+          ([num groups, len(groupby_col)] array of group values, AggEstimate
+          of [num groups] arrays).
+        """
+        start = time.time()
+        self.agg_col = agg_col
+        self.groupby_col = groupby_col
+        # Massages queries into natural order.
+        columns, operators, vals = FillInUnqueriedColumns(
+            self.table, columns, operators, vals)
+        orderings = self._sampling_orders(len(columns))
 
         with torch.no_grad():
-            inp_buf = self.inp.zero_()
-            # Fast (?) path.
-            if num_orderings == 1:
-                ordering = orderings[0]
+            if groupby_col is not None:
+                assert deadline_ms is None, 'GROUP BY has no deadline'
                 self.OnStart()
-                res = self._sample_n(
-                    self.num_samples,
-                    ordering if isinstance(
-                        self.model, transformer.Transformer) else inv_ordering,
-                    columns,
-                    operators,
-                    vals,
-                    inp=inp_buf,
-                    count=count)
+                values, probs, agg, groups = self._query_groups(
+                    orderings, columns, operators, vals, max_rows)
+                res = values, self._aggregate(probs, agg, groups,
+                                              len(values))
                 self.OnEnd()
                 return res
-                # return np.ceil(p * self.cardinality).astype(dtype=np.int32,
-                #                                             copy=False)
 
-            # Num orderings > 1.
-            ps = []
             self.OnStart()
-            for ordering in orderings:
-                p_scalar = self._sample_n(self.num_samples // num_orderings,
-                                          ordering, columns, operators, vals)
-                ps.append(p_scalar)
+            if self.exact_enumeration:
+                res = self._query_exact(orderings, columns, operators, vals,
+                                        max_rows)
+                if res is not None:
+                    self.query_num_samples.append(0)
+                    self.OnEnd()
+                    return res
+            deadline = None
+            if deadline_ms is not None:
+                deadline = start + deadline_ms / 1e3
+            res = self._sample_until_done(orderings, columns, operators,
+                                          vals, deadline)
             self.OnEnd()
-            return np.ceil(np.mean(ps) * self.cardinality).astype(
-                dtype=np.int32, copy=False)
+            return res
+
+    def _query_exact(self, orderings, columns, operators, vals, max_rows):
+        """Computes Query() exactly, if that is cheaper than sampling it.
+
+        Enumerates every value combination of the query region, see
+        _enumerate().  Its cost, the number of rows through forward passes,
+        is compared with that of one batch of 'r' samples.
+
+        Returns:
+          An AggEstimate with zero variances, or None to sample instead.
+        """
+        if not self.num_samples:
+            return None
+        select_col = self.table.ColumnIndex(self.agg_col)
+        valid_i_list = self._valid_masks(columns, operators, vals)
+        sizes = [
+            c.DistributionSize() if v is None else int(torch.count_nonzero(v))
+            for c, v in zip(columns, valid_i_list)
+        ]
+        enum_rows = sample_rows = 0
+        skipped = []
+        for ordering in orderings:
+            skipped.append(self._skipped(ordering, [operators], [select_col]))
+            rows, passes = self._enumeration_cost(ordering, skipped[-1], sizes)
+            enum_rows += rows
+            sample_rows += self.num_samples // len(orderings) * passes
+        if enum_rows > sample_rows:
+            return None
+
+        count = total = 0.
+        for ordering, skip in zip(orderings, skipped):
+            c, s = self._enumerate(ordering, valid_i_list, skip, select_col,
+                                   max_rows)
+            count += c / len(orderings)
+            total += s / len(orderings)
+        avg = total / count if count > 0 else 0.
+        return AggEstimate(avg=avg,
+                           count=self.cardinality * count,
+                           sum=self.cardinality * total,
+                           avg_var=0.,
+                           count_var=0.,
+                           sum_var=0.)
+
+    def _enumeration_cost(self, ordering, skipped, sizes):
+        """Rows and forward passes to enumerate a query region.
+
+        Args:
+          sizes: per-column number of valid codes, in natural order.
+
+        Returns:
+          rows: total rows fed through forward passes by _enumerate(), i.e.,
+            the number of distinct prefixes before each pass.
+          passes: number of forward passes runModel() makes.
+        """
+        rows = passes = 0
+        prefixes = 1
+        for i in range(len(ordering) - 1):
+            if not skipped[ordering[i]]:
+                prefixes *= sizes[ordering[i]]
+            if not skipped[ordering[i + 1]]:
+                rows += prefixes
+                passes += 1
+        return rows, passes
+
+    def _enumerate(self, ordering, valid_i_list, skipped, select_col,
+                   max_rows):
+        """Exact COUNT and SUM of a query region under one ordering.
+
+        Instead of sampling each column, expands every prefix of valid codes
+        by all valid codes of the column, weighting it by the conditional
+        probability of its path; the forward passes run over all prefixes,
+        in chunks of at most 'max_rows'.  The last column is summed over in
+        closed form, as in runModel().  Skipped wildcards are marginalized
+        by the model, as under sampling.
+
+        Returns:
+          count, sum: floats, fractions of the table.
+        """
+        ncol = len(valid_i_list)
+        inp = self.inp[:1].clone().zero_()
+        self._fill_wildcards(inp, skipped)
+        logits = self._init_logits(ordering)
+        weights = torch.ones(1, dtype=torch.float64, device=self.device)
+        ranks = torch.zeros(1, dtype=torch.float64, device=self.device)
+        for i in range(ncol):
+            natural_idx = ordering[i]
+            if not skipped[natural_idx]:
+                probs_i = torch.softmax(
+                    self.model.logits_for_col(natural_idx, logits),
+                    1).double()
+                valid = valid_i_list[natural_idx]
+                if i == ncol - 1:
+                    probs_i = _ApplyMask(probs_i, valid)
+                    mass = weights * probs_i.sum(1)
+                    if natural_idx == select_col:
+                        values = torch.arange(1,
+                                              probs_i.shape[1] + 1,
+                                              dtype=probs_i.dtype,
+                                              device=self.device)
+                        total = torch.dot(weights, torch.mv(probs_i, values))
+                    else:
+                        total = torch.dot(mass, ranks)
+                    return mass.sum().item(), total.item()
+
+                if valid is None:
+                    codes = torch.arange(probs_i.shape[1], device=self.device)
+                else:
+                    codes = torch.nonzero(valid).view(-1)
+                if len(codes) == 0:
+                    # Empty region.
+                    return 0., 0.
+                num_prefixes, k = len(weights), len(codes)
+                weights = (weights.view(-1, 1) * probs_i[:, codes]).view(-1)
+                if natural_idx == select_col:
+                    ranks = (codes + 1.).double().repeat(num_prefixes)
+                else:
+                    ranks = ranks.repeat_interleave(k)
+                inp = inp.repeat_interleave(k, 0)
+                block = self._input_block(natural_idx)
+                if block is not None:
+                    l, r = block
+                    data_to_encode = codes.repeat(num_prefixes).view(-1, 1)
+                    self.model.EncodeInput(data_to_encode,
+                                           natural_col=natural_idx,
+                                           out=inp[:, l:r])
+
+            if not skipped[ordering[i + 1]]:
+                logits = self._forward_rows(inp, ordering, max_rows)
+
+    def _forward_rows(self, inp, ordering, max_rows):
+        """Logits of all rows of 'inp', in chunks of at most 'max_rows'."""
+        chunks = []
+        for lo in range(0, len(inp), max_rows):
+            chunk = inp[lo:lo + max_rows]
+            if hasattr(self.model, 'do_forward'):
+                chunks.append(self.model.do_forward(chunk,
+                                                    np.argsort(ordering)))
+            else:
+                chunks.append(self.model.forward_with_encoded_input(chunk))
+        return torch.cat(chunks)
+
+    def _sample_until_done(self, orderings, columns, operators, vals,
+                           deadline):
+        """Draws batches of samples for Query() until its stopping rule.
+
+        Without a deadline, that is one batch of 'r' samples, or under
+        sequential sampling, batches of 'r' until the target CI width or
+        'max_samples'.  See Query() for the 'deadline' (a time.time()).
+        """
+        num_orderings = len(orderings)
+        # Smallest batch worth a round of forward passes.
+        min_batch = min(16 * num_orderings, self.num_samples)
+        ps, aggs = [], []
+        num_drawn = 0
+        res = None
+        done = out_of_time = False
+        while not done:
+            num = self.num_samples
+            if deadline is not None:
+                left_ms = (deadline - time.time()) * 1e3
+                # Leave some slack for misprediction.
+                num = min(num, self._samples_within(0.9 * left_ms))
+                if num < min_batch and res is not None:
+                    out_of_time = True
+                    break
+                num = max(num, min_batch)
+            if self.max_samples is not None:
+                num = min(num, self.max_samples - num_drawn)
+            num -= num % num_orderings
+            if num == 0:
+                break
+
+            batch_start = time.time()
+            probs, agg = self._draw(orderings, columns, operators, vals, num)
+            ps.append(probs)
+            aggs.append(agg)
+            num_drawn += len(probs)
+            res = self._aggregate(torch.cat(ps), torch.cat(aggs))
+            self._batch_ms.append((num, (time.time() - batch_start) * 1e3))
+
+            if self.rel_ci_width is not None:
+                done = self._converged(res)
+            elif deadline is None:
+                done = True
+            if self.max_samples is not None and num_drawn >= self.max_samples:
+                break
+        self.query_num_samples.append(num_drawn)
+        if self.rel_ci_width is None:
+            done = num_drawn >= self.num_samples
+        return res._replace(truncated=out_of_time and not done)
+
+    def _samples_within(self, ms):
+        """Predicted number of samples one more batch can take in 'ms'.
+
+        Fits batch time = overhead + cost per sample * num samples over the
+        most recent batches.  Zero if there are none yet.
+        """
+        if not self._batch_ms:
+            return 0
+        nums, times = zip(*self._batch_ms)
+        if len(set(nums)) > 1:
+            per_sample, overhead = np.polyfit(nums, times, 1)
+            overhead = max(overhead, 0.)
+        else:
+            per_sample, overhead = np.mean(times) / nums[0], 0.
+        if per_sample <= 0:
+            per_sample = np.sum(times) / np.sum(nums)
+        return max(0, int((ms - overhead) / per_sample))
+
+    def _draw(self, orderings, columns, operators, vals, num_samples):
+        """Draws 'num_samples' (at most 'r') samples, split across orderings.
+
+        Returns:
+          probs, agg: as in runModel().
+        """
+        num_orderings = len(orderings)
+        # Fast (?) path.
+        if num_orderings == 1:
+            res = self._sample_n(num_samples,
+                                 orderings[0],
+                                 columns,
+                                 operators,
+                                 vals,
+                                 inp=self.inp.zero_())
+        # Num orderings > 1.
+        elif getattr(self.model, 'orderings_cached', False):
+            res = self._sample_orderings(num_samples // num_orderings,
+                                         orderings, columns, operators, vals,
+                                         self.inp.zero_())
+        else:
+            ps, aggs = [], []
+            for ordering in orderings:
+                # Each ordering starts from an empty input; the previous
+                # one's samples would otherwise leak into it.
+                p, agg = self._sample_n(num_samples // num_orderings,
+                                        ordering,
+                                        columns,
+                                        operators,
+                                        vals,
+                                        inp=self.inp.zero_())
+                ps.append(p)
+                aggs.append(agg)
+            res = torch.cat(ps), torch.cat(aggs)
+        return res
+
+    def _converged(self, res):
+        """Whether AggEstimate 'res' meets the target relative CI width."""
+        for field in ['avg', 'count', 'sum']:
+            est = getattr(res, field)
+            lo, hi = res.Interval(field, self.confidence)
+            if hi - lo > self.rel_ci_width * abs(est):
+                return False
+        return True
+
+    def QueryBatch(self, queries, max_rows=2**14):
+        """Estimates many queries, stacking their samples into shared passes.
+
+        Each query keeps its own per-column valid masks and aggregated column,
+        but the samples of all queries go through each forward pass together,
+        in chunks of at most 'max_rows' samples.
+
+        This pays off only while per-pass overhead dominates, i.e., for few
+        samples per query; with many, the larger passes can be slower than a
+        loop of Query().  Exact enumeration is never used.  See
+        eval_model.py --bench-batch.
+
+        Args:
+          queries: list of (agg_col, columns, operators, vals), as in Query().
+            GROUP BY is not supported.
+          max_rows: cap on the number of samples per forward pass.
+
+        Returns:
+          A list of AggEstimate, one per query.
+        """
+        if len(queries) == 0:
+            return []
+        ncols = len(self.table.columns)
+        orderings = self._sampling_orders(ncols)
+        num_per_query = self.num_samples // len(orderings)
+        chunk = max(1, max_rows // num_per_query)
+
+        start = time.time()
+        ps = [[] for _ in queries]
+        aggs = [[] for _ in queries]
+        with torch.no_grad():
+            for lo in range(0, len(queries), chunk):
+                batch = queries[lo:lo + chunk]
+                num_rows = num_per_query * len(batch)
+                select_cols, operators_list, masks = [], [], []
+                for agg_col, columns, operators, vals in batch:
+                    columns, operators, vals = FillInUnqueriedColumns(
+                        self.table, columns, operators, vals)
+                    select_cols.append(self.table.ColumnIndex(agg_col))
+                    operators_list.append(operators)
+                    masks.append(self._valid_masks(columns, operators, vals))
+
+                # Stack into one [num queries, dom size] mask per column.
+                valid_i_list = [None] * ncols
+                for i in range(ncols):
+                    if all(m[i] is None for m in masks):
+                        continue
+                    ones = torch.ones(self.table.columns[i].DistributionSize(),
+                                      device=self.device)
+                    valid_i_list[i] = torch.stack([
+                        ones if m[i] is None else m[i] for m in masks
+                    ])
+                select = torch.as_tensor(
+                    select_cols,
+                    device=self.device).repeat_interleave(num_per_query)
+
+                for ordering in orderings:
+                    inp = self._input_buffer(num_rows)
+                    skipped = self._skipped(ordering, operators_list,
+                                            select_cols)
+                    self._fill_wildcards(inp, skipped)
+                    p, agg = self.runModel(valid_i_list, skipped,
+                                           self._init_logits(ordering),
+                                           ordering, inp, select, num_rows)
+                    for j, (p_j, agg_j) in enumerate(
+                            zip(p.split(num_per_query),
+                                agg.split(num_per_query))):
+                        ps[lo + j].append(p_j)
+                        aggs[lo + j].append(agg_j)
+
+            res = [
+                self._aggregate(torch.cat(p), torch.cat(agg))
+                for p, agg in zip(ps, aggs)
+            ]
+        # Amortize the batch's latency over its queries.
+        dur_ms = (time.time() - start) * 1e3 / len(queries)
+        self.query_starts.extend([start] * len(queries))
+        self.query_dur_ms.extend([dur_ms] * len(queries))
+        return res
 
 
 class SampleFromModel(CardEst):
@@ -859,7 +1893,7 @@ class BayesianNetwork(CardEst):
         self.discretize = discretize
         self.discretize_method = discretize_method
         self.dataset = dataset
-        self.original_table = self.dataset.tuples.numpy()
+        self.original_table = self.dataset.tuples.numpy().astype(np.float32)
         self.algorithm = algorithm
         self.topological_sampling_order = topological_sampling_order
         self.num_samples = num_samples
@@ -967,7 +2001,8 @@ class BayesianNetwork(CardEst):
             else:
                 op = OPS[operators[col_id]]
                 val = self.apply_discrete_mapping_to_value(
-                    self.dataset.table.val_to_bin_funcs[col_id](vals[col_id]),
+                    self.dataset.table.val_to_bin_funcs[col_id](
+                        vals[col_id], operators[col_id]),
                     col_id, self.discrete_mapping)
                 if self.discretize:
                     # avoid some bad cases
@@ -1038,7 +2073,8 @@ class BayesianNetwork(CardEst):
             else:
                 op = OPS[operators[col_id]]
                 val = self.apply_discrete_mapping_to_value(
-                    self.dataset.table.val_to_bin_funcs[col_id](vals[col_id]),
+                    self.dataset.table.val_to_bin_funcs[col_id](
+                        vals[col_id], operators[col_id]),
                     col_id, self.discrete_mapping)
                 if self.discretize:
                     # avoid some bad cases
@@ -1449,7 +2485,7 @@ class MaxDiffHistogram(CardEst):
         observed_cid = []
         for c, o, v in zip(columns, operators, vals):
             if not c.data.dtype == 'int64':
-                v = c.ValToBin(v)
+                v = c.ValToBin(v, o)
             cid = self.table.ColumnIndex(c.name)
             observed_cid.append(cid)
             spread = partition.uniform_spreads[cid]
@@ -1483,7 +2519,7 @@ class MaxDiffHistogram(CardEst):
         column_set_map = {}
         for c, o, v in zip(columns, operators, vals):
             if not c.data.dtype == 'int64':
-                v = c.ValToBin(v)
+                v = c.ValToBin(v, o)
             self._populate_column_set_map(c, o, v, column_set_map)
         # compute the set of pids that's relevant to this query
         relevant_pids = set()
@@ -17,6 +17,7 @@ import numpy as np
 import pandas as pd
 import torch
 
+import bundles
 import common
 import datasets
 import estimators as estimators_lib
@@ -38,6 +39,26 @@ parser = argparse.ArgumentParser()
 parser.add_argument('--query', type=bool, default=False, help='specific query')
 parser.add_argument('--groupby_col', type=str, help='columns for group by')
 parser.add_argument('--agg_col', type=str, help='columns for aggregate result')
+parser.add_argument('--group-discovery',
+                    action='store_true',
+                    help='GROUP BY: estimate only groups found by a pilot '
+                    'sampling pass, instead of every value combination.')
+parser.add_argument('--group-min-mass',
+                    type=float,
+                    default=0.,
+                    help='With --group-discovery, drop groups with less than '
+                    'this fraction of the table.')
+parser.add_argument('--group-top-k',
+                    type=int,
+                    default=None,
+                    help='With --group-discovery, keep only the k largest '
+                    'groups.')
+parser.add_argument('--group-allocation',
+                    type=str,
+                    default='even',
+                    choices=['even', 'adaptive'],
+                    help='GROUP BY: split samples evenly across groups, or '
+                    'by mass and variance from a pilot pass.')
 parser.add_argument('--where_col', type=str, help='format example: [col1, col2, col3]')
 parser.add_argument('--where_ops', type=str, help='format example: [[<],[=],[>,<]]')
 parser.add_argument('--where_val', type=str, help='format example: [[10], [2], [1, 1000]]')
@@ -49,6 +70,22 @@ parser.add_argument('--inference-opts',
 parser.add_argument('--num_queries', type=int, default=20, help='# queries.')
 parser.add_argument('--dataset', type=str, default='dmv-tiny', help='Dataset.')
 parser.add_argument('--col', nargs='+', help='Column names in the dataset that you want to use.')
+parser.add_argument(
+    '--table-cache-dir',
+    type=str,
+    default=None,
+    help='If set, cache the discretized table under this directory and '
+    'memory-map it on later runs, instead of re-parsing the CSV.')
+parser.add_argument('--table-workers',
+                    type=int,
+                    default=1,
+                    help='Processes to build the table\'s columns with.')
+parser.add_argument(
+    '--model-only',
+    action='store_true',
+    help='Build estimators from the table metadata saved next to the '
+    'checkpoints instead of loading --dataset.  Needs --query, as there is '
+    'no data to draw random queries or true results from.')
 parser.add_argument('--err-csv',
                     type=str,
                     default='results.csv',
@@ -63,6 +100,33 @@ parser.add_argument('--psample',
                     type=int,
                     default=2000,
                     help='# of progressive samples to use per query.')
+parser.add_argument(
+    '--rel-ci-width',
+    type=float,
+    default=None,
+    help='If set, draw --psample samples at a time until the 95%% '
+    'confidence intervals are at most this wide relative to the estimates.')
+parser.add_argument('--deadline-ms',
+                    type=float,
+                    default=None,
+                    help='If set, per-query time budget for progressive '
+                    'sampling, in ms.')
+parser.add_argument('--max-psample',
+                    type=int,
+                    default=None,
+                    help='With --rel-ci-width, max # of samples per query; '
+                    'defaults to 10 times --psample.')
+parser.add_argument('--sampler',
+                    type=str,
+                    default='multinomial',
+                    choices=['multinomial', 'stratified', 'systematic',
+                             'sobol'],
+                    help='How progressive sampling draws each column; see '
+                    'estimators.ProgressiveSampling.')
+parser.add_argument('--no-exact',
+                    action='store_true',
+                    help='Always sample, even for queries whose region is '
+                    'cheaper to enumerate exactly.')
 parser.add_argument(
     '--column_masking',
     action='store_true',
@@ -79,6 +143,10 @@ parser.add_argument('--fc-hiddens',
                     default=128,
                     help='Hidden units in FC.')
 parser.add_argument('--layers', type=int, default=4, help='# layers in FC.')
+parser.add_argument('--num_orderings',
+                    type=int,
+                    default=1,
+                    help='Number of orderings the MADE was trained with.')
 parser.add_argument('--residual', action='store_true', help='ResMade?')
 parser.add_argument('--direct-io', action='store_true', help='Do direct IO?')
 parser.add_argument(
@@ -158,6 +226,31 @@ parser.add_argument(
     help='Turn on to write results in results/'
 )
 
+# Batched inference.
+parser.add_argument(
+    '--bench-batch',
+    action='store_true',
+    help='Benchmark QueryBatch() against one-at-a-time Query() on '
+    '--num_queries random queries.')
+parser.add_argument('--batch-rows',
+                    type=int,
+                    default=2**14,
+                    help='Max # samples per forward pass in QueryBatch().')
+parser.add_argument(
+    '--bench-samplers',
+    action='store_true',
+    help='Benchmark error vs. # samples of each --sampler on --num_queries '
+    'random queries.')
+parser.add_argument('--bench-psamples',
+                    type=int,
+                    nargs='+',
+                    default=[100, 300, 1000, 3000],
+                    help='With --bench-samplers, # samples to try.')
+parser.add_argument('--bench-reps',
+                    type=int,
+                    default=5,
+                    help='With --bench-samplers, estimates per query.')
+
 args = parser.parse_args()
 
 
@@ -175,13 +268,23 @@ def InvertOrder(order):
 
 
 def MakeTable():
+    if args.model_only:
+        return MakeMetadataTable()
     # assert args.dataset in ['dmv-tiny', 'dmv']
     if args.dataset == 'dmv-tiny':
-        table = datasets.LoadDmv('dmv-tiny.csv')
+        table = datasets.LoadDmv('dmv-tiny.csv',
+                                 cache_dir=args.table_cache_dir,
+                                 num_workers=args.table_workers)
+    elif args.dataset.endswith('.cols'):
+        table = datasets.LoadColumnar(args.dataset, args.col)
     elif args.dataset == 'dmv':
-        table = datasets.LoadDmv()
+        table = datasets.LoadDmv(cache_dir=args.table_cache_dir,
+                                 num_workers=args.table_workers)
     else:
-        table = datasets.LoadMyDataset(args.dataset, args.col)
+        table = datasets.LoadMyDataset(args.dataset,
+                                       args.col,
+                                       cache_dir=args.table_cache_dir,
+                                       num_workers=args.table_workers)
     oracle_est = estimators_lib.Oracle(table)
 
     real_result = estimators_lib.RealResult(table)
@@ -190,6 +293,22 @@ def MakeTable():
     return table, None, oracle_est, real_result
 
 
+def MakeMetadataTable():
+    """Loads the table metadata saved next to the first checkpoint.
+
+    Column domains and the row count are all ProgressiveSampling needs, so
+    neither the base table nor the oracles are loaded.
+    """
+    ckpts = ParseCheckpoints()
+    assert ckpts, 'No checkpoints match --glob {}'.format(args.glob)
+    table = common.ColumnarTable(common.MetadataPath(ckpts[0].path), args.col)
+    for k, v in table.info.items():
+        if getattr(args, k, v) != v:
+            print('Using {}={} from the table metadata.'.format(k, v))
+        setattr(args, k, v)
+    return table, None, None, None
+
+
 def ErrorMetric(est_card, card):
     if card == 0 and est_card != 0:
         return est_card
@@ -304,6 +423,7 @@ def GenerateRandomQuery(table, groupby_cols):
     elif args.dataset == 'dmv.csv' or args.dataset == 'dmv-original.csv':
         select_cols.remove(3)
     if groupby_cols is not None:
+        groupby_cols = [table.ColumnIndex(col) for col in groupby_cols]
         for col in groupby_cols:
             select_cols.remove(col)
         #select_cols = [table.ColumnIndex('Model Year'), table.ColumnIndex('Weight_100')]
@@ -353,21 +473,36 @@ def GenerateRandomQuery(table, groupby_cols):
     return query
 
 
-def RunSingleQuery(est, est_avg, real, agg_col, where_col, where_ops, where_val, groupby_col):
+def RunSingleQuery(est, real, agg_col, where_col, where_ops, where_val, groupby_col):
     # Actual.
-    real_result = real.Query(agg_col, where_col, where_ops, where_val, groupby_col)
+    real_result = None
+    if real is not None:
+        real_result = real.Query(agg_col, where_col, where_ops, where_val,
+                                 groupby_col)
 
+    # AVG, COUNT and SUM all come from a single progressive sampling pass.
     if groupby_col is None:
-        est_result_avg = est_avg.Query(agg_col, where_col, where_ops, where_val, groupby_col, count=False)
-        est_result_count = est.Query(agg_col, where_col, where_ops, where_val, groupby_col, count=True)
-        est_result_sum = est_result_count*est_result_avg
-        est_result = [est_result_avg, est_result_count, est_result_sum]
+        res = est.Query(agg_col,
+                        where_col,
+                        where_ops,
+                        where_val,
+                        groupby_col,
+                        deadline_ms=args.deadline_ms)
+        est_result = [res.avg, res.count, res.sum]
+        if res.truncated:
+            print('Truncated by the {}ms deadline after {} samples'.format(
+                args.deadline_ms, est.query_num_samples[-1]))
+        print('95% CIs: avg [{:.4g}, {:.4g}], count [{:.4g}, {:.4g}], '
+              'sum [{:.4g}, {:.4g}]'.format(*res.Interval('avg'),
+                                            *res.Interval('count'),
+                                            *res.Interval('sum')))
     else:
-        vals, est_avg = est_avg.Query(agg_col, where_col, where_ops, where_val, groupby_col, count=False)
-        vals, est_count = est.Query(agg_col, where_col, where_ops, where_val, groupby_col, count=True)
-        mask = est_count > 0.5
-        est_sum = est_avg[mask] * est_count[mask]
-        est_result = [vals[mask], est_avg[mask], est_count[mask], est_sum]
+        vals, res = est.Query(agg_col, where_col, where_ops, where_val, groupby_col)
+        keep = res.count > 0.5
+        # Same layout as RealResult: group values, then AVG, COUNT, SUM.
+        est_result = [[*v, avg, count, s] for v, avg, count, s in zip(
+            vals[keep].tolist(), res.avg[keep].tolist(),
+            res.count[keep].tolist(), res.sum[keep].tolist())]
 
     return est_result, real_result
 
@@ -511,13 +646,14 @@ def MakeMade(scale, cols_to_train, seed, fixed_ordering=None, natural_ordering=F
         hidden_sizes=[scale] *
                      args.layers if args.layers > 0 else [512, 256, 512, 128, 1024],
         nout=sum([c.DistributionSize() for c in cols_to_train]),
+        num_masks=max(1, args.num_orderings),
         input_bins=[c.DistributionSize() for c in cols_to_train],
         input_encoding=args.input_encoding,
         output_encoding=args.output_encoding,
         embed_size=32,
         seed=seed,
         do_direct_io_connections=args.direct_io,
-        natural_ordering=natural_ordering,
+        natural_ordering=natural_ordering and args.num_orderings <= 1,
         residual_connections=args.residual,
         fixed_ordering=ordering if fixed_ordering else None,
         column_masking=args.column_masking,
@@ -590,7 +726,7 @@ def err(est, real):
 
 
 def saveResults(est_time, real_time, est_result, real_result, query, order, filename):
-    if len(est_result) == 3 and est_result[0] is not list:
+    if est_result and not isinstance(est_result[0], list):
         result = {
             'timestamp': str(datetime.now()),
             'dataset': args.dataset,
@@ -613,18 +749,22 @@ def saveResults(est_time, real_time, est_result, real_result, query, order, file
         }
 
     else:
+        # Rows are [group values..., avg, count, sum].
+        def group_key(row):
+            return row[0] if len(row) == 4 else str(tuple(row[:-3]))
+
         data = {
-            'avg_est': [row[1] for row in est_result],
-            'count_est': [row[2] for row in est_result],
-            'sum_est': [row[3] for row in est_result],
+            'avg_est': [row[-3] for row in est_result],
+            'count_est': [row[-2] for row in est_result],
+            'sum_est': [row[-1] for row in est_result],
         }
-        est_df = pd.DataFrame(data, index=[row[0] for row in est_result])
+        est_df = pd.DataFrame(data, index=[group_key(row) for row in est_result])
         data = {
-            'avg_real': [row[1] for row in real_result],
-            'count_real': [row[2] for row in real_result],
-            'sum_real': [row[3] for row in real_result],
+            'avg_real': [row[-3] for row in real_result],
+            'count_real': [row[-2] for row in real_result],
+            'sum_real': [row[-1] for row in real_result],
         }
-        real_df = pd.DataFrame(data, index=[row[0] for row in real_result])
+        real_df = pd.DataFrame(data, index=[group_key(row) for row in real_result])
         results = pd.concat([est_df, real_df], axis=1)
         avg_error = []
         cnt_error = []
@@ -675,33 +815,60 @@ def toQuery(agg_col, where_col, where_ops, where_val, groupby_col=None):
     return query
 
 
-def generateOrder(table, agg_col, groupby_col):
-    agg_idx = table.ColumnIndex(agg_col)
-    ncol = len(table.columns)
-    order = [*range(ncol)]
-    if groupby_col is not None:
-        groupby_idx = [table.ColumnIndex(n) for n in groupby_col]
-        order = [i for i in order if i not in groupby_idx]
-        order.extend(groupby_idx)
-    order.remove(agg_idx)
-    order.append(agg_idx)
-    return order
+# In-process caches.  Every query re-requests estimators for its own ordering;
+# without these, each request re-globs models/, rebuilds the model, runs
+# torch.load() and re-initializes ProgressiveSampling.
+_CKPT_CACHE = {}
+_MODEL_CACHE = {}
+_ESTIMATOR_CACHE = {}
 
 
-def loadEstimators(table, order, natural_ordering):
+def ArchKey():
+    """Flags that determine how a checkpoint is rebuilt into a model."""
+    return (args.heads, args.blocks, args.dmodel, args.dff,
+            args.transformer_act, args.fc_hiddens, args.layers, args.residual,
+            args.direct_io, args.input_encoding, args.output_encoding,
+            args.column_masking, args.num_orderings)
+
+
+def OrderKey(order, natural_ordering):
+    """Hashable ordering; MADE ignores 'order' under natural ordering."""
+    if order is None or (natural_ordering and args.heads == 0):
+        return None
+    return tuple(order)
+
+
+def ParseCheckpoints():
+    """Globs and parses checkpoint paths under models/ (cached)."""
+    key = (args.glob, args.blacklist)
+    if key in _CKPT_CACHE:
+        return _CKPT_CACHE[key]
+
     all_ckpts = glob.glob('./models/{}'.format(args.glob))
     if args.blacklist:
         all_ckpts = [ckpt for ckpt in all_ckpts if args.blacklist not in ckpt]
+    # Skip the table metadata saved next to each checkpoint.
+    all_ckpts = [ckpt for ckpt in all_ckpts if ckpt.endswith('.pt')]
 
     selected_ckpts = all_ckpts
-    oracle_cards = LoadOracleCardinalities()
     print('ckpts', selected_ckpts)
 
-    Ckpt = collections.namedtuple(
-        'Ckpt', 'epoch model_bits bits_gap path loaded_model seed')
+    Ckpt = collections.namedtuple('Ckpt',
+                                  'path model_bits bits_gap seed bundle')
     parsed_ckpts = []
-
     for s in selected_ckpts:
+        bundle = bundles.LoadBundle(s)
+        if bundle is not None:
+            info = bundle['info']
+            parsed_ckpts.append(
+                Ckpt(path=s,
+                     model_bits=info['model_bits'],
+                     bits_gap=info['model_bits'] - info['data_bits'],
+                     seed=info['seed'],
+                     bundle=bundle))
+            continue
+        # A plain state dict: parse the filename, and rebuild the model from
+        # the architecture flags.
         z = re.match('.+model([\d\.]+)-data([\d\.]+).+seed([\d\.]+).*.pt',
                      s)
         # if args.order is None:
@@ -714,42 +881,112 @@ def loadEstimators(table, order, natural_ordering):
         model_bits = float(z.group(1))
         data_bits = float(z.group(2))
         seed = int(z.group(3))
-        bits_gap = model_bits - data_bits
-
-        if args.heads > 0:
-            model = MakeTransformer(cols_to_train=table.columns,
-                                    fixed_ordering=order,
-                                    seed=seed)
-        else:
-            # if args.dataset in ['dmv-tiny', 'dmv']:
-            model = MakeMade(
-                scale=args.fc_hiddens,
-                cols_to_train=table.columns,
-                seed=seed,
-                fixed_ordering=order if not natural_ordering else None,
-                natural_ordering=natural_ordering
-            )
-            # else:
-            #     assert False, args.dataset
-
-        assert order is None or len(order) == model.nin, order
-        ReportModel(model)
-        print('Loading ckpt:', s)
-        model.load_state_dict(torch.load(s))
-        model.eval()
-
-        print(s, bits_gap, seed)
-
         parsed_ckpts.append(
             Ckpt(path=s,
-                 epoch=None,
                  model_bits=model_bits,
-                 bits_gap=bits_gap,
-                 loaded_model=model,
-                 seed=seed))
+                 bits_gap=model_bits - data_bits,
+                 seed=seed,
+                 bundle=None))
+    _CKPT_CACHE[key] = parsed_ckpts
+    return parsed_ckpts
+
+
+def LoadModel(table, ckpt, order, natural_ordering):
+    """Builds and loads 'ckpt', once per distinct ordering (cached)."""
+    if ckpt.bundle is not None:
+        # Architecture and ordering come from the bundle, not the flags.
+        if ckpt.path not in _MODEL_CACHE:
+            print('Loading bundle:', ckpt.path)
+            _MODEL_CACHE[ckpt.path] = bundles.BuildFromBundle(ckpt.bundle,
+                                                              table,
+                                                              device=DEVICE)
+        return _MODEL_CACHE[ckpt.path]
+
+    key = (ckpt.path, OrderKey(order, natural_ordering), natural_ordering,
+           ArchKey())
+    if key in _MODEL_CACHE:
+        return _MODEL_CACHE[key]
+
+    if args.heads > 0:
+        model = MakeTransformer(cols_to_train=table.columns,
+                                fixed_ordering=order,
+                                seed=ckpt.seed)
+    else:
+        # if args.dataset in ['dmv-tiny', 'dmv']:
+        model = MakeMade(
+            scale=args.fc_hiddens,
+            cols_to_train=table.columns,
+            seed=ckpt.seed,
+            fixed_ordering=order if not natural_ordering else None,
+            natural_ordering=natural_ordering
+        )
+        # else:
+        #     assert False, args.dataset
+
+    assert order is None or len(order) == model.nin, order
+    # Multi-mask checkpoints are named '...-<num masks>masks-...'.
+    z = re.search('-(\d+)masks-', os.path.basename(ckpt.path))
+    num_masks = int(z.group(1)) if z else 1
+    assert args.heads > 0 or num_masks == max(1, args.num_orderings), (
+        'Checkpoint has {} masks; pass --num_orderings={}'.format(
+            num_masks, num_masks))
+    ReportModel(model)
+    print('Loading ckpt:', ckpt.path)
+    model.load_state_dict(torch.load(ckpt.path))
+    model.eval()
+
+    print(ckpt.path, ckpt.bits_gap, ckpt.seed)
+    _MODEL_CACHE[key] = model
+    return model
+
+
+def MakeProgressiveSampling(table, ckpt, order, natural_ordering):
+    """Returns a ProgressiveSampling over 'ckpt', built once per key (cached)."""
+    key = (ckpt.path, OrderKey(order, natural_ordering), natural_ordering,
+           ArchKey(), args.psample, args.inference_opts, args.group_discovery,
+           args.group_min_mass, args.group_top_k, args.group_allocation,
+           args.rel_ci_width, args.max_psample, args.no_exact, args.sampler)
+    if key in _ESTIMATOR_CACHE:
+        return _ESTIMATOR_CACHE[key]
+
+    model = LoadModel(table, ckpt, order, natural_ordering)
+    est = estimators_lib.ProgressiveSampling(model,
+                                             table,
+                                             args.psample,
+                                             device=DEVICE,
+                                             shortcircuit=args.column_masking,
+                                             group_discovery=args.group_discovery,
+                                             group_min_mass=args.group_min_mass,
+                                             group_top_k=args.group_top_k,
+                                             group_allocation=args.group_allocation,
+                                             rel_ci_width=args.rel_ci_width,
+                                             max_samples=args.max_psample,
+                                             exact_enumeration=not args.no_exact,
+                                             sampler=args.sampler)
+    est.name = str(est) + '_{}_{:.3f}'.format(ckpt.seed, ckpt.bits_gap)
+
+    if args.inference_opts:
+        print('Tracing forward_with_encoded_input()...')
+        encoded_input = est.model.EncodeInput(
+            torch.zeros(args.psample, est.model.nin, device=DEVICE))
+
+        # NOTE: this line works with torch 1.0.1.post2 (but not 1.2).
+        # The 1.2 version changes the API to
+        # torch.jit.script(est.model) and requires an annotation --
+        # which was found to be slower.
+        est.traced_fwd = torch.jit.trace(est.model.forward_with_encoded_input,
+                                         encoded_input)
+
+    _ESTIMATOR_CACHE[key] = est
+    return est
+
+
+def loadEstimators(table, order, natural_ordering):
+    parsed_ckpts = ParseCheckpoints()
 
     # Estimators to run.
     if args.run_bn:
+        oracle_cards = LoadOracleCardinalities()
         estimators = RunNParallel(estimator_factory=MakeBnEstimators,
                                   parallelism=50,
                                   rng=np.random.RandomState(1234),
@@ -758,37 +995,25 @@ def loadEstimators(table, order, natural_ordering):
                                   oracle_cards=oracle_cards)
     else:
         estimators = [
-            estimators_lib.ProgressiveSampling(c.loaded_model,
-                                               table,
-                                               args.psample,
-                                               device=DEVICE,
-                                               shortcircuit=args.column_masking)
+            MakeProgressiveSampling(table, c, order, natural_ordering)
             for c in parsed_ckpts
         ]
-        for est, ckpt in zip(estimators, parsed_ckpts):
-            est.name = str(est) + '_{}_{:.3f}'.format(ckpt.seed, ckpt.bits_gap)
-
-        if args.inference_opts:
-            print('Tracing forward_with_encoded_input()...')
-            for est in estimators:
-                encoded_input = est.model.EncodeInput(
-                    torch.zeros(args.psample, est.model.nin, device=DEVICE))
-
-                # NOTE: this line works with torch 1.0.1.post2 (but not 1.2).
-                # The 1.2 version changes the API to
-                # torch.jit.script(est.model) and requires an annotation --
-                # which was found to be slower.
-                est.traced_fwd = torch.jit.trace(
-                    est.model.forward_with_encoded_input, encoded_input)
 
+        # Baselines do not depend on the ordering; build them once.
         if args.run_sampling:
             SAMPLE_RATIO = {'dmv': [0.0013]}  # ~1.3MB.
             for p in SAMPLE_RATIO.get(args.dataset, [0.01]):
-                estimators.append(estimators_lib.Sampling(table, p=p))
+                key = ('sampling', p)
+                if key not in _ESTIMATOR_CACHE:
+                    _ESTIMATOR_CACHE[key] = estimators_lib.Sampling(table, p=p)
+                estimators.append(_ESTIMATOR_CACHE[key])
 
         if args.run_maxdiff:
-            estimators.append(
-                estimators_lib.MaxDiffHistogram(table, args.maxdiff_limit))
+            key = ('maxdiff', args.maxdiff_limit)
+            if key not in _ESTIMATOR_CACHE:
+                _ESTIMATOR_CACHE[key] = estimators_lib.MaxDiffHistogram(
+                    table, args.maxdiff_limit)
+            estimators.append(_ESTIMATOR_CACHE[key])
 
         # Other estimators can be appended as well.
 
@@ -804,25 +1029,32 @@ def loadEstimators(table, order, natural_ordering):
         #          oracle_est=oracle_est)
     return estimators
 
-def RunSpecificQuery(table, real, agg_col, where_col, where_ops, where_val, groupby_col):
+def SamplingOrder(table):
+    """The order columns are sampled in.
+
+    AVG, COUNT and SUM are all read off one set of samples, so the samples are
+    drawn in the checkpoint's own ordering: --order if given, else natural.
+    """
     if args.order:
-        order = args.order
-    else:
-        order = generateOrder(table, agg_col, groupby_col)
+        return args.order
+    return list(range(len(table.columns)))
+
+
+def RunSpecificQuery(table, real, agg_col, where_col, where_ops, where_val, groupby_col):
+    order = SamplingOrder(table)
     querystr = toQuery(agg_col, where_col, where_ops, where_val, groupby_col)
     where_col = [table.ColumnIndex(i) for i in where_col]
     where_col = [table.columns[i] for i in where_col]
     print(querystr)
 
-    estimators1 = loadEstimators(table, order, natural_ordering=True)[0]
-    estimators2 = loadEstimators(table, order, natural_ordering=False)[0]
+    est = loadEstimators(table, args.order, natural_ordering=args.order is None)[0]
 
-    est_result, real_result = RunSingleQuery(estimators1, estimators2, real, agg_col, where_col, where_ops, where_val,
+    est_result, real_result = RunSingleQuery(est, real, agg_col, where_col, where_ops, where_val,
                                              groupby_col)
     print(est_result, real_result)
-    if args.result_path is not None:
+    if args.result_path is not None and real is not None:
         save_result = "results/" + args.result_path + "/query.json"
-        est_time = estimators1.query_dur_ms[0] + estimators2.query_dur_ms[0]
+        est_time = est.query_dur_ms[-1]
         saveResults(est_time, real.query_dur_ms[0], est_result, real_result, querystr, order, save_result)
         print('...Done, result:', save_result)
 
@@ -833,25 +1065,122 @@ def RunNRandomQuery(table, real, groupby_col):
         where_col = query['where_col']
         where_ops = query['where_ops']
         where_val = query['where_val']
-        order = generateOrder(table, agg_col, groupby_col)
-        print(order)
+        order = SamplingOrder(table)
         querystr = toQuery(agg_col, [c.Name() for c in where_col],
                            where_ops, where_val, groupby_col)
         print(querystr)
-        estimators1 = loadEstimators(table, order, natural_ordering=True)[0]
-        estimators2 = loadEstimators(table, order, natural_ordering=False)[0]
-        est_result, real_result = RunSingleQuery(estimators1, estimators2, real, agg_col, where_col,
+        est = loadEstimators(table, args.order, natural_ordering=args.order is None)[0]
+        est_result, real_result = RunSingleQuery(est, real, agg_col, where_col,
                                                  where_ops, where_val, groupby_col)
 
         if args.result_path is not None:
             save_result = "results/" + args.result_path + "/query" + str(i) + '.json'
-            est_time = estimators1.query_dur_ms[0] + estimators2.query_dur_ms[0]
+            est_time = est.query_dur_ms[-1]
             real_time = real.query_dur_ms[i]
             saveResults(est_time, real_time, est_result, real_result, querystr, order, save_result)
             print('...Done, result:', save_result)
 
 
+def BenchmarkQueryBatch(table, real):
+    """Reports queries/sec of QueryBatch() vs. a loop of Query().
+
+    QueryBatch() always samples, so Query() is run with exact enumeration
+    off too; both sides then draw the same number of samples per query.
+    """
+    model = loadEstimators(table, args.order,
+                           natural_ordering=args.order is None)[0].model
+    est = estimators_lib.ProgressiveSampling(model,
+                                             table,
+                                             args.psample,
+                                             device=DEVICE,
+                                             shortcircuit=args.column_masking,
+                                             exact_enumeration=False,
+                                             sampler=args.sampler)
+    queries = []
+    for _ in range(args.num_queries):
+        query = GenerateRandomQuery(table, None)
+        queries.append((query['agg_col'], list(query['where_col']),
+                        list(query['where_ops']), query['where_val']))
+
+    start = time.time()
+    singles = [est.Query(*q, None) for q in queries]
+    single_secs = time.time() - start
+
+    start = time.time()
+    batched = est.QueryBatch(queries, max_rows=args.batch_rows)
+    batch_secs = time.time() - start
+
+    errs = [[], []]
+    for q, s, b in zip(queries, singles, batched):
+        real_count = real.Query(*q, None)[1]
+        errs[0].append(ErrorMetric(s.count, real_count))
+        errs[1].append(ErrorMetric(b.count, real_count))
+    print('{} queries, {} samples each'.format(len(queries), est.num_samples))
+    print('Query():      {:.1f} queries/sec, median count q-error {:.3f}'.format(
+        len(queries) / single_secs, np.median(errs[0])))
+    print('QueryBatch(): {:.1f} queries/sec, median count q-error {:.3f}'.format(
+        len(queries) / batch_secs, np.median(errs[1])))
+    # < 1 means batching is slower than the loop.
+    print('QueryBatch() / Query() throughput: {:.2f}x'.format(single_secs /
+                                                             batch_secs))
+
+
+def BenchmarkSamplers(table, real):
+    """Reports COUNT error vs. # samples of each sampler.
+
+    Sampling error is measured against the same model's estimate from 16x
+    the largest --bench-psamples (multinomial), so that it isn't masked by
+    the model's own error; the q-error against the true count is reported
+    too.  Exact enumeration is off, so every query is sampled.
+    """
+    model = loadEstimators(table, args.order,
+                           natural_ordering=args.order is None)[0].model
+    queries = []
+    for _ in range(args.num_queries):
+        query = GenerateRandomQuery(table, None)
+        queries.append((query['agg_col'], list(query['where_col']),
+                        list(query['where_ops']), query['where_val']))
+    real_counts = [real.Query(*q, None)[1] for q in queries]
+
+    def make(sampler, num_samples):
+        return estimators_lib.ProgressiveSampling(
+            model,
+            table,
+            num_samples,
+            device=DEVICE,
+            shortcircuit=args.column_masking,
+            exact_enumeration=False,
+            sampler=sampler)
+
+    ref = make('multinomial', 16 * max(args.bench_psamples))
+    ref_counts = [ref.Query(*q, None).count for q in queries]
+
+    print('{} queries, {} estimates each; reference: {} samples'.format(
+        len(queries), args.bench_reps, ref.num_samples))
+    print('{:>12} {:>8} {:>14} {:>12} {:>10}'.format('sampler', 'psample',
+                                                     'rms rel err %',
+                                                     'median qerr', 'ms/query'))
+    for num_samples in args.bench_psamples:
+        for sampler in ['multinomial', 'stratified', 'systematic', 'sobol']:
+            est = make(sampler, num_samples)
+            rel_errs, q_errs = [], []
+            start = time.time()
+            for q, ref_count, real_count in zip(queries, ref_counts,
+                                                real_counts):
+                for _ in range(args.bench_reps):
+                    count = est.Query(*q, None).count
+                    if ref_count > 0:
+                        rel_errs.append(count / ref_count - 1)
+                    q_errs.append(ErrorMetric(count, real_count))
+            ms = (time.time() - start) * 1e3 / len(q_errs)
+            print('{:>12} {:>8} {:>14.3f} {:>12.3f} {:>10.1f}'.format(
+                sampler, num_samples,
+                100 * np.sqrt(np.mean(np.square(rel_errs))),
+                np.median(q_errs), ms))
+
+
 def Main():
+    assert args.query or not args.model_only, '--model-only needs --query'
     if args.groupby_col is not None:
         groupby_col = ast.literal_eval(args.groupby_col)
     else:
@@ -873,7 +1202,12 @@ def Main():
         if not args.run_bn:
             # OK to load tables now
             table, train_data, oracle_est, real = MakeTable()
-        RunNRandomQuery(table, real, groupby_col)
+        if args.bench_batch:
+            BenchmarkQueryBatch(table, real)
+        elif args.bench_samplers:
+            BenchmarkSamplers(table, real)
+        else:
+            RunNRandomQuery(table, real, groupby_col)
 
     # SaveEstimators(args.err_csv, estimators)
     # print('...Done, result:', args.err_csv)
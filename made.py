@@ -15,6 +15,8 @@ class MaskedLinear(nn.Linear):
         self.register_buffer('mask', torch.ones(out_features, in_features))
 
         self.masked_weight = None
+        # [num orderings, out, in]; see MADE.cache_masked_weights().
+        self.ordering_weights = None
 
     def set_mask(self, mask):
         """Accepts a mask of shape [in_features, out_features]."""
@@ -28,6 +30,12 @@ class MaskedLinear(nn.Linear):
             return F.linear(input, self.masked_weight, self.bias)
 
 
+def _MaskedWeight(layer):
+    if layer.masked_weight is not None:
+        return layer.masked_weight
+    return layer.mask * layer.weight
+
+
 class MaskedResidualBlock(nn.Module):
 
     def __init__(self, in_features, out_features, activation):
@@ -109,6 +117,27 @@ class MADE(nn.Module):
         super().__init__()
         print('fixed_ordering', fixed_ordering, 'seed', seed,
               'natural_ordering', natural_ordering)
+        # Constructor arguments, stored in checkpoint bundles; see
+        # bundles.SaveBundle().
+        self.config = {
+            'nin': nin,
+            'hidden_sizes': list(hidden_sizes),
+            'nout': int(nout),
+            'num_masks': num_masks,
+            'natural_ordering': natural_ordering,
+            'input_bins': [int(b) for b in input_bins],
+            'activation': activation.__name__,
+            'do_direct_io_connections': do_direct_io_connections,
+            'input_encoding': input_encoding,
+            'output_encoding': output_encoding,
+            'embed_size': embed_size,
+            'input_no_emb_if_leq': input_no_emb_if_leq,
+            'residual_connections': residual_connections,
+            'column_masking': column_masking,
+            'seed': seed,
+            'fixed_ordering': None if fixed_ordering is None else
+                              [int(o) for o in fixed_ordering],
+        }
         self.nin = nin
         assert input_encoding in [None, 'one_hot', 'binary', 'embed']
         self.input_encoding = input_encoding
@@ -199,21 +228,32 @@ class MADE(nn.Module):
         self.logit_indices = np.cumsum(encoded_bins)
         self.m = {}
 
-        self.update_masks()
-        self.orderings = [self.m[-1]]
+        # The orderings update_masks() cycles through.
+        orderings = []
+        for _ in range(num_masks):
+            self.update_masks()
+            orderings.append(self.m[-1])
+        self.orderings = orderings
+        # Whether cache_masked_weights() was called.
+        self.orderings_cached = False
 
         # Optimization: cache some values needed in EncodeInput().
         self.bin_as_onehot_shifts = None
 
+    def _ordering_index(self, ordering):
+        for i in range(len(self.orderings)):
+            if np.array_equal(self.orderings[i], ordering):
+                return i
+        assert False, 'specified={}, avail={}'.format(ordering, self.orderings)
+
     def _build_or_update_direct_io(self):
         assert self.nout > self.nin and self.input_bins is not None
         direct_nin = self.net[0].in_features
         direct_nout = self.net[-1].out_features
         if self.direct_io_layer is None:
             self.direct_io_layer = MaskedLinear(direct_nin, direct_nout)
-        mask = np.zeros((direct_nout, direct_nin), dtype=np.uint8)
-
         if self.natural_ordering:
+            mask = np.zeros((direct_nout, direct_nin), dtype=np.uint8)
             curr = 0
             for i in range(self.nin):
                 dist_size = self._get_input_encoded_dist_size(
@@ -222,27 +262,14 @@ class MADE(nn.Module):
                 mask[self.logit_indices[i]:, curr:dist_size] = 1
                 curr += dist_size
         else:
-            # Inverse: ord_idx -> natural idx.
-            inv_ordering = [None] * self.nin
-            for natural_idx in range(self.nin):
-                inv_ordering[self.m[-1][natural_idx]] = natural_idx
-
-            for ord_i in range(self.nin):
-                nat_i = inv_ordering[ord_i]
-                # x_(nat_i) in the input occupies range [inp_l, inp_r).
-                inp_l = 0 if nat_i == 0 else self.input_bins_encoded_cumsum[
-                    nat_i - 1]
-                inp_r = self.input_bins_encoded_cumsum[nat_i]
-                assert inp_l < inp_r
-
-                for ord_j in range(ord_i + 1, self.nin):
-                    nat_j = inv_ordering[ord_j]
-                    # Output x_(nat_j) should connect to input x_(nat_i); it
-                    # occupies range [out_l, out_r) in the output.
-                    out_l = 0 if nat_j == 0 else self.logit_indices[nat_j - 1]
-                    out_r = self.logit_indices[nat_j]
-                    assert out_l < out_r
-                    mask[out_l:out_r, inp_l:inp_r] = 1
+            # Output x_j connects to input x_i iff x_i comes first in the
+            # ordering; m[-1] maps natural idx -> position.
+            positions = np.asarray(self.m[-1])
+            out_positions = np.repeat(positions,
+                                      np.diff(self.logit_indices, prepend=0))
+            inp_positions = np.repeat(positions, self.input_bins_encoded)
+            mask = (out_positions[:, None] >
+                    inp_positions[None, :]).astype(np.uint8)
         mask = mask.T
         self.direct_io_layer.set_mask(mask)
 
@@ -283,48 +310,40 @@ class MADE(nn.Module):
             return
         L = len(self.hidden_sizes)
 
+        # The i-th of the 'num_masks' orderings, and its hidden units'
+        # connectivity, is drawn with seed init_seed + i:
+        #
+        #   orderings = [ o0, o1, o2, ... ]
+        #   seeds = [ init_seed, init_seed+1, init_seed+2, ... ]
+        #
+        # Uses ordering 'invoke_order' if specified, else the next one in turn.
+        if invoke_order is not None:
+            i = self._ordering_index(invoke_order)
+        else:
+            i = self.seed - self.init_seed
+        self.seed = self.init_seed + (i + 1) % self.num_masks
+        rng = np.random.RandomState(self.init_seed + i)
+
         ### Precedence of several params determining ordering:
         #
-        # invoke_order
         # orderings
         # fixed_ordering
         # natural_ordering
         #
         # from high precedence to low.
-
-        if invoke_order is not None:
-            found = False
-            for i in range(len(self.orderings)):
-                if np.array_equal(self.orderings[i], invoke_order):
-                    found = True
-                    break
-            assert found, 'specified={}, avail={}'.format(
-                ordering, self.orderings)
-            # orderings = [ o0, o1, o2, ... ]
-            # seeds = [ init_seed, init_seed+1, init_seed+2, ... ]
-            rng = np.random.RandomState(self.init_seed + i)
-            self.seed = (self.init_seed + i + 1) % self.num_masks
-            self.m[-1] = invoke_order
-        elif hasattr(self, 'orderings'):
-            # Cycle through the special orderings.
-            rng = np.random.RandomState(self.seed)
-            self.seed = (self.seed + 1) % self.num_masks
-            self.m[-1] = self.orderings[self.seed % 4]
-        else:
-            rng = np.random.RandomState(self.seed)
-            self.seed = (self.seed + 1) % self.num_masks
-            self.m[-1] = np.arange(
-                self.nin) if self.natural_ordering else rng.permutation(
-                    self.nin)
-            if self.fixed_ordering is not None:
-                self.m[-1] = np.asarray(self.fixed_ordering)
+        self.m[-1] = np.arange(
+            self.nin) if self.natural_ordering else rng.permutation(self.nin)
+        if self.fixed_ordering is not None:
+            self.m[-1] = np.asarray(self.fixed_ordering)
+        if hasattr(self, 'orderings'):
+            self.m[-1] = np.asarray(self.orderings[i])
 
         if self.nin > 1:
             for l in range(L):
                 if self.residual_connections:
                     # Sequential assignment for ResMade: https://arxiv.org/pdf/1904.05626.pdf
-                    self.m[l] = np.array([(k - 1) % (self.nin - 1)
-                                          for k in range(self.hidden_sizes[l])])
+                    self.m[l] = (np.arange(self.hidden_sizes[l]) -
+                                 1) % (self.nin - 1)
                 else:
                     # Samples from [0, ncols - 1).
                     self.m[l] = rng.randint(self.m[l - 1].min(),
@@ -350,36 +369,16 @@ class MADE(nn.Module):
             else:
                 # [x1, ..., x1], ..., [xn, ..., xn] where the i-th list has
                 # input_bins[i - 1] many elements (multiplicity, # of classes).
-                mask = np.asarray([])
-                for k in range(masks[-1].shape[0]):
-                    tmp_mask = []
-                    for idx, x in enumerate(zip(masks[-1][k], self.input_bins)):
-                        mval, nbins = x[0], self._get_output_encoded_dist_size(
-                            x[1])
-                        tmp_mask.extend([mval] * nbins)
-                    tmp_mask = np.asarray(tmp_mask)
-                    if k == 0:
-                        mask = tmp_mask
-                    else:
-                        mask = np.vstack([mask, tmp_mask])
-                masks[-1] = mask
+                encoded_bins = list(
+                    map(self._get_output_encoded_dist_size, self.input_bins))
+                masks[-1] = np.repeat(masks[-1], encoded_bins, axis=1)
 
         if self.input_encoding is not None:
             # Input layer's mask should be changed.
 
             assert self.input_bins is not None
-            # [nin, hidden].
-            mask0 = masks[0]
-            new_mask0 = []
-            for i, dist_size in enumerate(self.input_bins):
-                dist_size = self._get_input_encoded_dist_size(dist_size)
-                # [dist size, hidden]
-                new_mask0.append(
-                    np.concatenate([mask0[i].reshape(1, -1)] * dist_size,
-                                   axis=0))
-            # [sum(dist size), hidden]
-            new_mask0 = np.vstack(new_mask0)
-            masks[0] = new_mask0
+            # [nin, hidden] -> [sum(dist size), hidden].
+            masks[0] = np.repeat(masks[0], self.input_bins_encoded, axis=0)
 
         layers = [
             l for l in self.net if isinstance(l, MaskedLinear) or
@@ -605,7 +604,7 @@ class MADE(nn.Module):
         elif self.input_encoding == 'embed':
             return self.Embed(data, natural_col=natural_col, out=out)
         elif self.input_encoding is None:
-            return data
+            return data.float()
         elif self.input_encoding == 'one_hot':
             return self.ToOneHot(data)
         else:
@@ -634,14 +633,91 @@ class MADE(nn.Module):
 
         return self.net(x)
 
+    def masked_weights(self):
+        """Each MaskedLinear's mask * weight under the current ordering.
+
+        Returns:
+          A dict of module name -> detached masked weight.
+        """
+        return {
+            name: _MaskedWeight(layer).detach()
+            for name, layer in self.named_modules()
+            if isinstance(layer, MaskedLinear)
+        }
+
+    def cache_masked_weights(self):
+        """Precomputes each layer's masked weight under every ordering.
+
+        Afterwards, do_forward() switches orderings by pointing each layer at
+        its cached weight instead of rebuilding the masks, and
+        forward_orderings() runs all orderings in one batched pass.
+        Inference only: weights must not change in between.
+        """
+        layers = [l for l in self.modules() if isinstance(l, MaskedLinear)]
+        weights = [[] for _ in layers]
+        for ordering in self.orderings:
+            self.update_masks(invoke_order=ordering)
+            for j, layer in enumerate(layers):
+                weights[j].append(layer.mask * layer.weight)
+        for layer, w in zip(layers, weights):
+            layer.ordering_weights = torch.stack(w)
+        self.orderings_cached = True
+        self._use_ordering(len(self.orderings) - 1)
+
+    def _use_ordering(self, i):
+        self.m[-1] = self.orderings[i]
+        for layer in self.modules():
+            if isinstance(layer, MaskedLinear):
+                layer.masked_weight = layer.ordering_weights[i]
+
     def do_forward(self, x, ordering):
         """Performs forward pass, invoking a specified ordering."""
-        self.update_masks(invoke_order=ordering)
+        if self.orderings_cached:
+            self._use_ordering(self._ordering_index(ordering))
+        else:
+            self.update_masks(invoke_order=ordering)
         if self.direct_io_layer is not None:
             residual = self.direct_io_layer(x)
             return self.net(x) + residual
         return self.net(x)
 
+    def forward_orderings(self, x):
+        """Forward pass of encoded input 'x' under all orderings at once.
+
+        Requires cache_masked_weights().
+
+        Args:
+          x: [num orderings * bs, encoded input size]; the i-th block of bs
+            rows goes through the i-th ordering in self.orderings.
+
+        Returns:
+          [num orderings * bs, nout] logits, in the same blocks.
+        """
+        assert self.orderings_cached
+        x = x.view(len(self.orderings), -1, x.shape[-1])
+        out = self._forward_orderings(self.net, x)
+        if self.direct_io_layer is not None:
+            out = out + self._forward_orderings(self.direct_io_layer, x)
+        return out.view(-1, out.shape[-1])
+
+    def _forward_orderings(self, module, x):
+        """Applies 'module' to [num orderings, bs, in] 'x', per ordering."""
+        if isinstance(module, MaskedLinear):
+            return torch.baddbmm(module.bias, x,
+                                 module.ordering_weights.transpose(1, 2))
+        if isinstance(module, MaskedResidualBlock):
+            out = module.activation(x)
+            out = self._forward_orderings(module.layers[0], out)
+            out = module.activation(out)
+            out = self._forward_orderings(module.layers[1], out)
+            return x + out
+        if isinstance(module, nn.Sequential):
+            for m in module:
+                x = self._forward_orderings(m, x)
+            return x
+        # Activations.
+        return module(x)
+
     def forward_with_encoded_input(self, x):
 
         if self.direct_io_layer is not None:
@@ -650,20 +726,88 @@ class MADE(nn.Module):
 
         return self.net(x)
 
+    def init_incremental(self, x):
+        """Starts an incremental forward pass over encoded input 'x'.
+
+        Progressive sampling fills in one column of the input at a time, so
+        the first layer's pre-activations (and the direct-IO output) can be
+        updated with just that column's block of weights instead of being
+        recomputed.  Inference only: weights must not change in between.
+
+        Args:
+          x: [bs, encoded input size]; bs may be 1 if all rows are equal.
+
+        Returns:
+          The state to pass to update_incremental()/forward_incremental().
+        """
+        first = self.net[0]
+        state = {
+            'weight': _MaskedWeight(first),
+            'hidden': first(x),
+            'out_weight': _MaskedWeight(self.net[-1]),
+            'direct_io_weight': None,
+            'direct_io': None,
+        }
+        if self.direct_io_layer is not None:
+            state['direct_io_weight'] = _MaskedWeight(self.direct_io_layer)
+            state['direct_io'] = self.direct_io_layer(x)
+        return state
+
+    def update_incremental(self, state, delta, natural_col):
+        """Adds 'delta', a change to column 'natural_col''s input block.
+
+        Args:
+          delta: [bs, encoded size of column 'natural_col'].
+        """
+        l = 0 if natural_col == 0 else self.input_bins_encoded_cumsum[
+            natural_col - 1]
+        r = self.input_bins_encoded_cumsum[natural_col]
+        state['hidden'] = torch.addmm(state['hidden'], delta,
+                                      state['weight'][:, l:r].t())
+        if state['direct_io'] is not None:
+            state['direct_io'] = torch.addmm(
+                state['direct_io'], delta, state['direct_io_weight'][:, l:r].t())
+
+    def forward_incremental(self, state, natural_col=None):
+        """Equivalent to forward_with_encoded_input() on the current input.
+
+        Args:
+          natural_col: if not None, only computes the outputs of this column,
+            i.e., the output layer rows that logits_for_col() reads.  Its
+            cost then scales with this column's domain instead of nout.
+
+        Returns:
+          [bs, nout], or [bs, encoded output size of 'natural_col'].
+        """
+        if natural_col is None:
+            lo, hi = 0, self.logit_indices[-1]
+        else:
+            lo = 0 if natural_col == 0 else self.logit_indices[natural_col - 1]
+            hi = self.logit_indices[natural_col]
+        # Copy: plain MADE applies an in-place activation next.
+        h = self.net[1:-1](state['hidden'].clone())
+        out = F.linear(h, state['out_weight'][lo:hi], self.net[-1].bias[lo:hi])
+        if state['direct_io'] is not None:
+            out = out + state['direct_io'][:, lo:hi]
+        return out
+
     def logits_for_col(self, idx, logits):
         """Returns the logits (vector) corresponding to log p(x_i | x_(<i)).
 
         Args:
           idx: int, in natural (table) ordering.
           logits: [batch size, hidden] where hidden can either be sum(dom
-            sizes), or emb_dims.
+            sizes), or emb_dims; or column idx's slice of it only (see
+            forward_incremental()).
 
         Returns:
           logits_for_col: [batch size, domain size for column idx].
         """
         assert self.input_bins is not None
 
-        if idx == 0:
+        if logits.shape[1] != self.logit_indices[-1]:
+            logits_for_var = logits
+        elif idx == 0:
             logits_for_var = logits[:, :self.logit_indices[0]]
         else:
             logits_for_var = logits[:, self.logit_indices[idx - 1]:self.
@@ -757,4 +901,37 @@ if __name__ == '__main__':
             print('depends', depends_ix, 'prev_idxs', prev_idxs)
             assert len(torch.nonzero(inp.grad[0, var_idx:])) == 0
         print('ok')
-    print('[MADE] Passes autoregressive-ness check!')
\ No newline at end of file
+    print('[MADE] Passes autoregressive-ness check!')
+
+    # Checks that incremental first-layer updates match a full forward pass.
+    for residual in [False, True]:
+        input_bins = [5, 300, 2, 40]
+        model = MADE(len(input_bins), [64, 64],
+                     sum(input_bins),
+                     input_bins=input_bins,
+                     input_encoding='binary',
+                     output_encoding='one_hot',
+                     residual_connections=residual,
+                     do_direct_io_connections=True)
+        model.eval()
+        with torch.no_grad():
+            x = torch.zeros(8, model.input_bins_encoded_cumsum[-1])
+            state = model.init_incremental(x[:1])
+            for i, dom in enumerate(input_bins):
+                l = 0 if i == 0 else model.input_bins_encoded_cumsum[i - 1]
+                r = model.input_bins_encoded_cumsum[i]
+                model.EncodeInput(torch.randint(dom, (8, 1)),
+                                  natural_col=i,
+                                  out=x[:, l:r])
+                model.update_incremental(state, x[:, l:r], i)
+                full = model.forward_with_encoded_input(x)
+                assert torch.allclose(model.forward_incremental(state),
+                                      full,
+                                      atol=1e-5)
+                for j in range(len(input_bins)):
+                    assert torch.allclose(
+                        model.logits_for_col(
+                            j, model.forward_incremental(state, j)),
+                        model.logits_for_col(j, full),
+                        atol=1e-5)
+    print('[MADE] Passes incremental forward check!')
@@ -0,0 +1,81 @@
+import contextlib
+import io
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import bundles
+import common
+import made
+import transformer
+
+
+def _MakeTable():
+    rng = np.random.RandomState(0)
+    df = pd.DataFrame({
+        'a': rng.randint(0, 5, 500),
+        'b': rng.randint(0, 20, 500),
+        'c': rng.randint(0, 8, 500),
+    })
+    with contextlib.redirect_stdout(io.StringIO()):
+        return common.CsvTable('syn', df, list(df.columns))
+
+
+def _MakeModels(bins):
+    return [
+        lambda: made.MADE(len(bins), [32, 32],
+                          sum(bins),
+                          input_bins=bins,
+                          input_encoding='binary',
+                          output_encoding='one_hot',
+                          residual_connections=True,
+                          do_direct_io_connections=True,
+                          seed=0),
+        lambda: made.MADE(len(bins), [32, 32],
+                          sum(bins),
+                          num_masks=3,
+                          natural_ordering=False,
+                          input_bins=bins,
+                          input_encoding='binary',
+                          output_encoding='one_hot',
+                          seed=0),
+        lambda: transformer.Transformer(num_blocks=1,
+                                        d_model=16,
+                                        d_ff=32,
+                                        num_heads=2,
+                                        nin=len(bins),
+                                        input_bins=bins),
+    ]
+
+
+def test_bundle_matches_plain_checkpoint(tmp_path):
+    table = _MakeTable()
+    bins = [c.DistributionSize() for c in table.columns]
+    x = torch.stack(
+        [torch.randint(b, (64,), generator=torch.Generator().manual_seed(0))
+         for b in bins], 1)
+    for i, make_model in enumerate(_MakeModels(bins)):
+        torch.manual_seed(i)
+        with contextlib.redirect_stdout(io.StringIO()):
+            trained = make_model()
+        plain_path = str(tmp_path / 'plain{}.pt'.format(i))
+        bundle_path = str(tmp_path / 'bundle{}.pt'.format(i))
+        torch.save(trained.state_dict(), plain_path)
+        bundles.SaveBundle(trained, table, bundle_path, seed=0)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            plain = make_model()
+        plain.load_state_dict(torch.load(plain_path))
+        plain.eval()
+        assert bundles.LoadBundle(plain_path) is None
+        with contextlib.redirect_stdout(io.StringIO()):
+            loaded = bundles.BuildFromBundle(bundles.LoadBundle(bundle_path),
+                                             table)
+        assert not loaded.training
+        with torch.no_grad():
+            assert torch.equal(loaded(x), plain(x)), type(plain).__name__
@@ -0,0 +1,126 @@
+import contextlib
+import io
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import common
+import estimators
+
+
+def test_vals_to_bins_absent_literals():
+    col = common.Column('x')
+    col.SetDistribution(np.array([np.nan, 1., 3., 5.]))
+    dvs = col.all_distinct_values
+    for val in [0., 2., 3., 6.]:
+        for op in ['<', '<=', '>', '>=', '=']:
+            code = col.ValToBin(val, op)
+            # Non-null values selected over codes and over values.
+            by_code = [
+                dvs[i] for i in range(1, len(dvs))
+                if estimators.OPS[op](i, code)
+            ]
+            by_val = [v for v in dvs[1:] if estimators.OPS[op](v, val)]
+            assert by_code == by_val, (val, op, code)
+    assert col.ValToBin(3.) == 2
+
+
+def _WriteCsv(path, num_rows=300):
+    rng = np.random.RandomState(0)
+    b = rng.randint(0, 7, num_rows).astype(float)
+    b[rng.rand(num_rows) < 0.1] = np.nan
+    df = pd.DataFrame({
+        'a': rng.randint(0, 50, num_rows),
+        'b': b,
+        'c': rng.choice(['x', 'y', 'z'], num_rows),
+    })
+    df.to_csv(path, index=False)
+
+
+def _AssertSameTable(table, expected):
+    assert [c.name for c in table.columns] == [c.name for c in expected.columns]
+    assert table.cardinality == expected.cardinality
+    for col, exp in zip(table.columns, expected.columns):
+        pd.testing.assert_index_equal(pd.Index(col.all_distinct_values),
+                                      pd.Index(exp.all_distinct_values))
+        np.testing.assert_array_equal(
+            common.Discretize(col) if col.codes is None else col.codes,
+            common.Discretize(exp))
+    if getattr(table, 'codes', None) is not None:
+        np.testing.assert_array_equal(
+            table.codes,
+            np.stack([common.Discretize(c) for c in expected.columns], 1))
+
+
+def test_csv_table_cache(tmp_path):
+    path = str(tmp_path / 't.csv')
+    _WriteCsv(path)
+    cols = ['a', 'b', 'c']
+    cache_dir = str(tmp_path / 'cache')
+    with contextlib.redirect_stdout(io.StringIO()):
+        plain = common.CsvTable('t', path, cols)
+        cold = common.CsvTable('t', path, cols, cache_dir=cache_dir)
+        warm = common.CsvTable('t', path, cols, cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 1
+    _AssertSameTable(cold, plain)
+    _AssertSameTable(warm, plain)
+    # Warm loads keep the codes memory-mapped and decode values on access.
+    assert isinstance(warm.codes, np.memmap)
+    assert warm._data is None
+    pd.testing.assert_frame_equal(warm.data, plain.data)
+
+    # A changed file gets a new cache entry.
+    _WriteCsv(path, num_rows=200)
+    with contextlib.redirect_stdout(io.StringIO()):
+        changed = common.CsvTable('t', path, cols, cache_dir=cache_dir)
+    assert changed.cardinality == 200
+    assert len(os.listdir(cache_dir)) == 2
+
+
+def test_csv_table_parallel_build(tmp_path):
+    path = str(tmp_path / 't.csv')
+    _WriteCsv(path)
+    cols = ['a', 'b', 'c']
+    with contextlib.redirect_stdout(io.StringIO()):
+        plain = common.CsvTable('t', path, cols)
+        parallel = common.CsvTable('t', path, cols, num_workers=2)
+    # The workers discretize the columns too.
+    assert parallel.codes is not None
+    _AssertSameTable(parallel, plain)
+    pd.testing.assert_frame_equal(parallel.data, plain.data)
+
+
+def test_csv_table_chunked(tmp_path):
+    path = str(tmp_path / 't.csv')
+    _WriteCsv(path)
+    cols = ['a', 'b', 'c']
+    with contextlib.redirect_stdout(io.StringIO()):
+        plain = common.CsvTable('t', path, cols)
+        chunked = common.CsvTable('t',
+                                  path,
+                                  cols,
+                                  cache_dir=str(tmp_path / 'cache'),
+                                  chunksize=64)
+    # Out-of-core: only the memory-mapped codes hold the table.
+    assert chunked.data is None
+    assert isinstance(chunked.codes, np.memmap)
+    _AssertSameTable(chunked, plain)
+
+
+def test_columnar_table(tmp_path):
+    path = str(tmp_path / 't.csv')
+    _WriteCsv(path)
+    cols = ['a', 'b', 'c']
+    with contextlib.redirect_stdout(io.StringIO()):
+        plain = common.CsvTable('t', path, cols)
+        common.SaveColumnar(plain, str(tmp_path / 't.cols'))
+        columnar = common.ColumnarTable(str(tmp_path / 't.cols'))
+        subset = common.ColumnarTable(str(tmp_path / 't.cols'), ['c', 'a'])
+    _AssertSameTable(columnar, plain)
+    pd.testing.assert_frame_equal(columnar.data, plain.data)
+    assert [c.name for c in subset.columns] == ['c', 'a']
+    np.testing.assert_array_equal(subset.codes, columnar.codes[:, [2, 0]])
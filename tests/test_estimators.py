@@ -0,0 +1,364 @@
+import contextlib
+import io
+import itertools
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import common
+import estimators
+import made
+import transformer
+
+
+def _MakeTable():
+    rng = np.random.RandomState(0)
+    df = pd.DataFrame({
+        'a': rng.randint(0, 5, 500),
+        'b': rng.randint(0, 20, 500),
+        'c': rng.randint(0, 8, 500),
+    })
+    with contextlib.redirect_stdout(io.StringIO()):
+        return common.CsvTable('syn', df, list(df.columns))
+
+
+def _MakeMade(table):
+    torch.manual_seed(0)
+    bins = [c.DistributionSize() for c in table.columns]
+    with contextlib.redirect_stdout(io.StringIO()):
+        model = made.MADE(len(bins), [32, 32],
+                          sum(bins),
+                          input_bins=bins,
+                          input_encoding='binary',
+                          output_encoding='one_hot',
+                          column_masking=True)
+    model.eval()
+    return model
+
+
+def _MakeTransformer(table):
+    torch.manual_seed(0)
+    bins = [c.DistributionSize() for c in table.columns]
+    with contextlib.redirect_stdout(io.StringIO()):
+        model = transformer.Transformer(num_blocks=1,
+                                        d_model=16,
+                                        d_ff=32,
+                                        num_heads=2,
+                                        nin=len(bins),
+                                        input_bins=bins,
+                                        column_masking=True)
+    model.eval()
+    return model
+
+
+def test_shortcircuit_first_column_wildcard():
+    # Under shortcircuit, the unfiltered first column is skipped before any
+    # column is sampled.
+    table = _MakeTable()
+    with contextlib.redirect_stdout(io.StringIO()):
+        est = estimators.ProgressiveSampling(_MakeMade(table),
+                                             table,
+                                             200,
+                                             device='cpu',
+                                             shortcircuit=True,
+                                             exact_enumeration=False)
+    cols = table.columns
+    res = est.Query('c', [cols[1]], [['>=']], [[10]], None)
+    assert 0 < res.count < table.cardinality
+    assert 0 <= res.avg <= cols[2].DistributionSize()
+
+
+def test_shortcircuit_first_column_wildcard_all_paths():
+    # The same query through every sampler, sequential and deadline-driven
+    # sampling, GROUP BY and QueryBatch(); for MADE and Transformer.
+    table = _MakeTable()
+    cols = table.columns
+    for make_model in [_MakeMade, _MakeTransformer]:
+        model = make_model(table)
+        for kwargs in [{
+                'sampler': 'multinomial'
+        }, {
+                'sampler': 'stratified'
+        }, {
+                'sampler': 'systematic'
+        }, {
+                'sampler': 'sobol'
+        }, {
+                'rel_ci_width': 0.5,
+                'max_samples': 400
+        }]:
+            with contextlib.redirect_stdout(io.StringIO()):
+                est = estimators.ProgressiveSampling(model,
+                                                     table,
+                                                     200,
+                                                     device='cpu',
+                                                     shortcircuit=True,
+                                                     exact_enumeration=False,
+                                                     **kwargs)
+            res = est.Query('c', [cols[1]], [['>=']], [[10]], None)
+            assert 0 < res.count < table.cardinality
+        res = est.Query('c', [cols[1]], [['>=']], [[10]],
+                        None,
+                        deadline_ms=1e3)
+        assert 0 < res.count < table.cardinality
+        values, res = est.Query('c', [cols[1]], [['>=']], [[10]], ['b'])
+        assert len(values) == len(res.count) == 10
+        res, = est.QueryBatch([('c', [cols[1]], [['>=']], [[10]])])
+        assert 0 < res.count < table.cardinality
+
+
+def test_init_logits_per_ordering():
+    # A multi-mask MADE's first column is conditioned on nothing, but under
+    # each ordering's own mask.
+    table = _MakeTable()
+    bins = [c.DistributionSize() for c in table.columns]
+    with contextlib.redirect_stdout(io.StringIO()):
+        model = made.MADE(len(bins), [32, 32],
+                          sum(bins),
+                          num_masks=3,
+                          natural_ordering=False,
+                          input_bins=bins,
+                          input_encoding='binary',
+                          output_encoding='one_hot',
+                          do_direct_io_connections=True,
+                          seed=0)
+        model.eval()
+        est = estimators.ProgressiveSampling(model, table, 200, device='cpu')
+    zeros = model.EncodeInput(torch.zeros(1, model.nin))
+    for ordering in est._sampling_orders(len(bins)):
+        expected = model.do_forward(zeros, np.argsort(ordering))
+        assert torch.allclose(est._init_logits(ordering), expected, atol=1e-6)
+
+
+def test_serial_orderings_start_from_empty_input():
+    # Without cached per-ordering weights, orderings are sampled one after
+    # another in the same input buffer.
+    table = _MakeTable()
+    bins = [c.DistributionSize() for c in table.columns]
+    with contextlib.redirect_stdout(io.StringIO()):
+        model = made.MADE(len(bins), [32, 32],
+                          sum(bins),
+                          num_masks=3,
+                          natural_ordering=False,
+                          input_bins=bins,
+                          input_encoding='binary',
+                          output_encoding='one_hot',
+                          seed=0)
+        model.eval()
+        est = estimators.ProgressiveSampling(model,
+                                             table,
+                                             300,
+                                             device='cpu',
+                                             exact_enumeration=False)
+    model.orderings_cached = False
+    sample_n = est._sample_n
+    starts = []
+
+    def _SampleN(*args, **kwargs):
+        starts.append(float(kwargs['inp'].abs().sum()))
+        return sample_n(*args, **kwargs)
+
+    est._sample_n = _SampleN
+    cols = table.columns
+    res = est.Query('c', [cols[1]], [['>=']], [[10]], None)
+    assert starts == [0.] * 3
+    assert 0 < res.count < table.cardinality
+
+
+def test_model_only_table(tmp_path):
+    # The metadata saved next to a checkpoint stands in for the base table.
+    table = _MakeTable()
+    model = _MakeMade(table)
+    with contextlib.redirect_stdout(io.StringIO()):
+        common.SaveColumnar(table, str(tmp_path / 'meta'), codes=False)
+        meta = common.ColumnarTable(str(tmp_path / 'meta'))
+    assert meta.data is None and meta.codes is None
+    assert meta.cardinality == table.cardinality
+    results = []
+    for t in [table, meta]:
+        with contextlib.redirect_stdout(io.StringIO()):
+            est = estimators.ProgressiveSampling(model,
+                                                 t,
+                                                 200,
+                                                 device='cpu',
+                                                 exact_enumeration=False)
+        torch.manual_seed(0)
+        results.append(
+            est.Query('c', [t.columns[0], t.columns[1]], [['<='], ['>']],
+                      [[2], [5]], None))
+    assert results[0] == results[1]
+
+
+def _Query(table):
+    cols = table.columns
+    return ('c', [cols[0], cols[1]], [['<='], ['>']], [[2], [5]])
+
+
+def _ExactAnswer(model, table):
+    # Many samples make enumerating the (small) query region the cheaper
+    # way to answer it.
+    with contextlib.redirect_stdout(io.StringIO()):
+        est = estimators.ProgressiveSampling(model, table, 20000, device='cpu')
+    res = est.Query(*_Query(table), None)
+    assert res.count_var == 0, res
+    return res
+
+
+def test_rel_ci_width():
+    # The untrained model is close to uniform, hence the tight target.
+    table = _MakeTable()
+    model = _MakeMade(table)
+    exact = _ExactAnswer(model, table)
+    with contextlib.redirect_stdout(io.StringIO()):
+        est = estimators.ProgressiveSampling(model,
+                                             table,
+                                             100,
+                                             device='cpu',
+                                             exact_enumeration=False,
+                                             rel_ci_width=3e-4,
+                                             max_samples=10**5)
+    torch.manual_seed(0)
+    res = est.Query(*_Query(table), None)
+    # More batches than one were needed, and the target width was met.
+    assert 100 < est.query_num_samples[-1] < 10**5
+    for field in ['avg', 'count', 'sum']:
+        lo, hi = res.Interval(field)
+        assert hi - lo <= 3e-4 * abs(getattr(res, field)), field
+        assert lo <= getattr(exact, field) <= hi, field
+
+
+def test_deadline():
+    table = _MakeTable()
+    model = _MakeMade(table)
+    exact = _ExactAnswer(model, table)
+    with contextlib.redirect_stdout(io.StringIO()):
+        est = estimators.ProgressiveSampling(model,
+                                             table,
+                                             1000,
+                                             device='cpu',
+                                             exact_enumeration=False,
+                                             max_samples=3000)
+    torch.manual_seed(0)
+    # An expired deadline still gets one small batch, flagged as truncated.
+    res = est.Query(*_Query(table), None, deadline_ms=1e-6)
+    assert res.truncated
+    assert 0 < est.query_num_samples[-1] < 1000
+    assert 0 < res.count < table.cardinality
+    # A generous one keeps sampling, up to 'max_samples'.
+    res = est.Query(*_Query(table), None, deadline_ms=6e4)
+    assert not res.truncated
+    assert est.query_num_samples[-1] == 3000
+    lo, hi = res.Interval('count')
+    assert lo <= exact.count <= hi
+
+
+def test_exact_enumeration():
+    # Enumeration is exact: it matches summing the model's joint over the
+    # query region, and sampling agrees with it within the CI.
+    table = _MakeTable()
+    bins = [c.DistributionSize() for c in table.columns]
+    x = torch.tensor(list(itertools.product(*[range(b) for b in bins])))
+    a, b = [
+        col.all_distinct_values[x[:, i].numpy()]
+        for i, col in enumerate(table.columns[:2])
+    ]
+    in_region = torch.as_tensor((a <= 2) & (b > 5))
+    # Aggregates are over ranks, i.e., codes + 1.
+    ranks = (x[:, 2] + 1.).double()[in_region]
+    for make_model in [_MakeMade, _MakeTransformer]:
+        model = make_model(table)
+        with torch.no_grad():
+            logits = model(x)
+            log_p = sum(
+                torch.log_softmax(model.logits_for_col(i, logits),
+                                  -1).gather(1, x[:, i:i + 1]).squeeze(1)
+                for i in range(len(bins)))
+        p = log_p.exp()[in_region].double()
+        exact = _ExactAnswer(model, table)
+        assert np.isclose(exact.count, table.cardinality * p.sum().item())
+        assert np.isclose(
+            exact.avg, (p * ranks).sum().item() / p.sum().item())
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            est = estimators.ProgressiveSampling(model,
+                                                 table,
+                                                 1000,
+                                                 device='cpu',
+                                                 exact_enumeration=False)
+        torch.manual_seed(0)
+        res = est.Query(*_Query(table), None)
+        for field in ['avg', 'count', 'sum']:
+            lo, hi = res.Interval(field)
+            assert lo <= getattr(exact, field) <= hi, field
+
+
+def test_samplers_reduce_error():
+    table = _MakeTable()
+    for make_model in [_MakeMade, _MakeTransformer]:
+        model = make_model(table)
+        exact = _ExactAnswer(model, table)
+        rms_errs = {}
+        for sampler in ['multinomial', 'stratified', 'systematic', 'sobol']:
+            with contextlib.redirect_stdout(io.StringIO()):
+                est = estimators.ProgressiveSampling(model,
+                                                     table,
+                                                     100,
+                                                     device='cpu',
+                                                     exact_enumeration=False,
+                                                     sampler=sampler)
+            torch.manual_seed(0)
+            errs = []
+            for _ in range(20):
+                res = est.Query(*_Query(table), None)
+                errs.append(res.count - exact.count)
+            lo, hi = res.Interval('count')
+            assert lo <= exact.count <= hi, sampler
+            rms_errs[sampler] = np.sqrt(np.mean(np.square(errs)))
+        for sampler in ['stratified', 'systematic', 'sobol']:
+            assert rms_errs[sampler] < rms_errs['multinomial'], rms_errs
+
+
+def _AssertIncrementalMatchesFull(model, table):
+    results = []
+    for incremental in [True, False]:
+        with contextlib.redirect_stdout(io.StringIO()):
+            est = estimators.ProgressiveSampling(model,
+                                                 table,
+                                                 200,
+                                                 device='cpu',
+                                                 exact_enumeration=False)
+        assert est.incremental
+        est.incremental = incremental
+        torch.manual_seed(0)
+        results.append(est.Query(*_Query(table), None))
+    for field in ['avg', 'count', 'sum']:
+        assert np.isclose(getattr(results[0], field),
+                          getattr(results[1], field),
+                          rtol=1e-5), field
+
+
+def test_made_incremental():
+    # Direct-IO and residual blocks have their own incremental updates.
+    table = _MakeTable()
+    bins = [c.DistributionSize() for c in table.columns]
+    torch.manual_seed(0)
+    with contextlib.redirect_stdout(io.StringIO()):
+        model = made.MADE(len(bins), [32, 32],
+                          sum(bins),
+                          input_bins=bins,
+                          input_encoding='binary',
+                          output_encoding='one_hot',
+                          residual_connections=True,
+                          do_direct_io_connections=True)
+    model.eval()
+    _AssertIncrementalMatchesFull(model, table)
+
+
+def test_transformer_incremental():
+    table = _MakeTable()
+    _AssertIncrementalMatchesFull(_MakeTransformer(table), table)
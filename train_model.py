@@ -8,6 +8,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+import bundles
 import common
 import datasets
 import made
@@ -21,6 +22,22 @@ parser = argparse.ArgumentParser()
 # Training.
 parser.add_argument('--dataset', type=str, default='dmv-tiny', help='Dataset.')
 parser.add_argument('--col', nargs='+', help='Column names in the dataset that you want to use.')
+parser.add_argument(
+    '--table-cache-dir',
+    type=str,
+    default=None,
+    help='If set, cache the discretized table under this directory and '
+    'memory-map it on later runs, instead of re-parsing the CSV.')
+parser.add_argument('--table-workers',
+                    type=int,
+                    default=1,
+                    help='Processes to build the table\'s columns with.')
+parser.add_argument(
+    '--table-chunksize',
+    type=int,
+    default=None,
+    help='If set, ingest the CSV out-of-core, this many rows at a time, into '
+    '--table-cache-dir (required) without building a DataFrame.')
 parser.add_argument('--num-gpus', type=int, default=0, help='#gpus.')
 parser.add_argument('--bs', type=int, default=1024, help='Batch size.')
 parser.add_argument(
@@ -170,7 +187,8 @@ def RunEpoch(split,
         if upto and step >= upto:
             break
 
-        xb = xb.to(DEVICE).to(torch.float32)
+        # Integer codes; the encoders take them as is.
+        xb = xb.to(DEVICE)
 
         # Forward pass, potentially through several orderings.
         xbhat = None
@@ -192,6 +210,7 @@ def RunEpoch(split,
             xbhat += model_out
 
         if xbhat.shape == xb.shape:
+            xb = xb.to(torch.float32)
             if mean:
                 xb = (xb * std) + mean
             loss = F.binary_cross_entropy_with_logits(
@@ -289,13 +308,15 @@ def MakeMade(scale, cols_to_train, seed, fixed_ordering=None):
         hidden_sizes=[scale] *
         args.layers if args.layers > 0 else [512, 256, 512, 128, 1024],
         nout=sum([c.DistributionSize() for c in cols_to_train]),
+        num_masks=max(1, args.num_orderings),
         input_bins=[c.DistributionSize() for c in cols_to_train],
         input_encoding=args.input_encoding,
         output_encoding=args.output_encoding,
         embed_size=32,
         seed=seed,
         do_direct_io_connections=args.direct_io,
-        natural_ordering=False if seed is not None and seed != 0 else True,
+        natural_ordering=(seed is None or seed == 0) and
+        args.num_orderings <= 1,
         residual_connections=args.residual,
         fixed_ordering=fixed_ordering,
         column_masking=args.column_masking,
@@ -334,23 +355,39 @@ def TrainTask(seed=0):
 
     # assert args.dataset in ['dmv-tiny', 'dmv']
     if args.dataset == 'dmv-tiny':
-        table = datasets.LoadDmv('dmv-tiny.csv')
+        table = datasets.LoadDmv('dmv-tiny.csv',
+                                 cache_dir=args.table_cache_dir,
+                                 num_workers=args.table_workers,
+                                 chunksize=args.table_chunksize)
+    elif args.dataset.endswith('.cols'):
+        table = datasets.LoadColumnar(args.dataset, args.col)
     elif args.dataset == 'dmv':
-        table = datasets.LoadDmv()
+        table = datasets.LoadDmv(cache_dir=args.table_cache_dir,
+                                 num_workers=args.table_workers,
+                                 chunksize=args.table_chunksize)
     else:
-        table = datasets.LoadMyDataset(args.dataset, args.col)
-
-    table_bits = Entropy(
-        table,
-        table.data.fillna(value=0).groupby([c.name for c in table.columns]).size()
-            .reset_index(name='size')["size"].to_numpy(), [2])[0]
+        table = datasets.LoadMyDataset(args.dataset,
+                                       args.col,
+                                       cache_dir=args.table_cache_dir,
+                                       num_workers=args.table_workers,
+                                       chunksize=args.table_chunksize)
+
+    if table.data is None:
+        # Out-of-core: count distinct rows over the codes.
+        counts = np.unique(table.codes, axis=0, return_counts=True)[1]
+    else:
+        counts = table.data.fillna(value=0).groupby(
+            [c.name for c in table.columns]).size().reset_index(
+                name='size')["size"].to_numpy()
+    table_bits = Entropy(table, counts, [2])[0]
     fixed_ordering = None
 
     if args.order is not None:
         print('Using passed-in order:', args.order)
         fixed_ordering = args.order
 
-    print(table.data.info())
+    if table.data is not None:
+        print(table.data.info())
 
     table_train = table
 
@@ -445,7 +482,22 @@ def TrainTask(seed=0):
             args.dataset, mb, model.model_bits, table_bits, model.name(),
             args.epochs, seed, '_'.join(map(str, fixed_ordering)), annot)
     os.makedirs(os.path.dirname(PATH), exist_ok=True)
-    torch.save(model.state_dict(), PATH)
+    bundles.SaveBundle(model,
+                       table,
+                       PATH,
+                       model_bits=float(model.model_bits),
+                       data_bits=float(table_bits),
+                       seed=seed,
+                       epochs=args.epochs)
+    # Lets estimators be built without loading the base table; see
+    # eval_model.py's --model-only.
+    common.SaveColumnar(table,
+                        common.MetadataPath(PATH),
+                        codes=False,
+                        info={
+                            'input_encoding': args.input_encoding,
+                            'output_encoding': args.output_encoding,
+                        })
     print('Saved to:')
     print(PATH)
 
@@ -207,6 +207,41 @@ class MultiHeadSelfAttention(nn.Module):
         x = self.linear(x)
         return x
 
+    def cache_kv(self, cache, x, pos):
+        """Incremental decoding: caches the key/value of position 'pos'.
+
+        Args:
+          cache: dict with 'k', 'v', each [bs, num heads, seq len, d_state].
+          x: [bs, d_model], the (normalized) input at 'pos'.
+
+        Returns:
+          The query of 'x', [bs, num heads, 1, d_state].
+        """
+        qs, ks, vs = map(self._split_heads,
+                         torch.chunk(self.qkv_linear(x.unsqueeze(1)), 3,
+                                     dim=-1))
+        cache['k'][:, :, pos] = ks[:, :, 0]
+        cache['v'][:, :, pos] = vs[:, :, 0]
+        return qs
+
+    def query(self, x):
+        """Incremental decoding: [bs, d_model] -> [bs, num heads, 1, d_state]."""
+        qs = torch.chunk(self.qkv_linear(x.unsqueeze(1)), 3, dim=-1)[0]
+        return self._split_heads(qs)
+
+    def attend(self, cache, query, pos):
+        """Incremental decoding: output at 'pos' from cached keys/values.
+
+        Args:
+          query: [bs or 1, num heads, 1, d_state].
+
+        Returns:
+          [bs, d_model], same as forward()'s output at 'pos'.
+        """
+        mask = self.attn_mask[pos:pos + 1].to(query.device)
+        x = self._do_attention(query, cache['k'], cache['v'], mask=mask)
+        return self.linear(x.view(x.shape[0], -1))
+
 
 class GeLU(nn.Module):
 
@@ -263,6 +298,37 @@ class Block(nn.Module):
 
         return x
 
+    def forward_incremental(self, cache, x, pos, query_input=None,
+                            cached=False):
+        """Same as forward() at position 'pos', given cached keys/values.
+
+        Args:
+          cache: this block's key/value cache, see cache_kv().
+          x: [bs, d_model], the input at 'pos'.
+          query_input: optional [1, d_model] to compute the query from.
+          cached: whether the key/value of 'x' is cached already.
+
+        Returns:
+          [bs, d_model].
+        """
+        residual = x
+        x = self.norm1(x)
+        if not cached:
+            query = self.attn.cache_kv(cache, x, pos)
+        if query_input is not None:
+            query = self.attn.query(query_input)
+        elif cached:
+            query = self.attn.query(x)
+        x = self.attn.attend(cache, query, pos)
+        if self.do_residual:
+            x = x + residual
+
+        residual = x
+        x = self.mlp(self.norm2(x))
+        if self.do_residual:
+            x = x + residual
+        return x
+
 
 class Transformer(nn.Module):
     """An autoregressive Transformer (decoder only)."""
@@ -334,6 +400,21 @@ class Transformer(nn.Module):
                 self.fixed_ordering = np.random.RandomState(seed).permutation(
                     natural)
         print('ordering', self.fixed_ordering)
+        # Constructor arguments, stored in checkpoint bundles; see
+        # bundles.SaveBundle().
+        self.config = {
+            'num_blocks': num_blocks,
+            'd_model': d_model,
+            'd_ff': d_ff,
+            'num_heads': num_heads,
+            'nin': nin,
+            'input_bins': [int(b) for b in input_bins],
+            'use_positional_embs': use_positional_embs,
+            'activation': activation,
+            'column_masking': column_masking,
+            'fixed_ordering': [int(o) for o in self.fixed_ordering],
+            'seed': seed,
+        }
 
         # Build.
         self.blocks = nn.Sequential(*[
@@ -506,8 +587,8 @@ class Transformer(nn.Module):
                 # Let's also add E_pos=0 to SOS (if enabled).
                 out.copy_(
                     self.pos_embeddings(torch.as_tensor(
-                        0,
-                        device=x.device)).unsqueeze(0).expand(x.size()[0], -1))
+                        0, device=out.device)).unsqueeze(0).expand(
+                            out.shape[0], -1))
             return
 
         if x is None:
@@ -565,6 +646,100 @@ class Transformer(nn.Module):
         x = self.norm(x)
         return x
 
+    def init_incremental(self, x, filled_cols=()):
+        """Starts incremental decoding over encoded input 'x'.
+
+        Progressive sampling fills in one column at a time.  Instead of
+        re-running every position through every block after each column,
+        this caches each block's keys/values and runs only the newly needed
+        position through the blocks.  Inference only.
+
+        Args:
+          x: [bs, (num cols + 1) * d_model], as from EncodeInput(); bs may be
+            1 if all rows are equal.  SOS must be encoded.
+          filled_cols: natural indices of the columns already encoded in
+            'x' (e.g., wildcards).
+
+        Returns:
+          The state to pass to update_incremental()/forward_incremental().
+        """
+        bs = x.shape[0]
+        x = x.view(bs, -1, self.d_model)
+        seq_len = x.shape[1]
+        d_state = self.d_model // self.num_heads
+        state = {
+            'inputs': x,
+            'caches': [{
+                'k': torch.zeros(bs, self.num_heads, seq_len, d_state,
+                                 device=x.device),
+                'v': torch.zeros(bs, self.num_heads, seq_len, d_state,
+                                 device=x.device),
+            } for _ in self.blocks],
+            # Number of columns (in self.fixed_ordering) run through blocks.
+            'num_done': 0,
+            'outputs': [None] * self.nin,
+        }
+        self._cache_input(state, 0)
+        for natural_col in filled_cols:
+            self._cache_input(state, natural_col + 1)
+        return state
+
+    def _cache_input(self, state, pos):
+        """Caches block 0's key/value of input position 'pos'."""
+        if pos >= state['inputs'].shape[1]:
+            # Scheme 0 has no input slot for the last column.
+            return
+        self.blocks[0].attn.cache_kv(state['caches'][0],
+                                     self.blocks[0].norm1(
+                                         state['inputs'][:, pos]), pos)
+
+    def update_incremental(self, state, delta, natural_col):
+        """Registers the newly encoded input of column 'natural_col'.
+
+        Args:
+          delta: [bs, d_model], the input block of 'natural_col', which was
+            zero before.
+        """
+        bs = delta.shape[0]
+        if state['inputs'].shape[0] != bs:
+            # Rows were shared so far.
+            state['inputs'] = state['inputs'].expand(bs, -1, -1).clone()
+            for cache in state['caches']:
+                for k in cache:
+                    cache[k] = cache[k].expand(bs, -1, -1, -1).clone()
+        pos = natural_col + 1
+        if pos < state['inputs'].shape[1]:
+            state['inputs'][:, pos] = delta
+        self._cache_input(state, pos)
+
+    def forward_incremental(self, state, natural_col):
+        """Returns the final hidden of 'natural_col', [bs, d_model].
+
+        Runs the positions of all columns up to 'natural_col' (in the
+        model's ordering) through the blocks, if not done yet.  Pass the
+        result to logits_for_col().
+        """
+        if MASK_SCHEME == 1:
+            pos_embs = self.pos_embeddings.weight
+        while state['outputs'][natural_col] is None:
+            pos = self.fixed_ordering[state['num_done']]
+            x = state['inputs'][:, pos]
+            for i, (block, cache) in enumerate(zip(self.blocks,
+                                                   state['caches'])):
+                if i == 0 and MASK_SCHEME == 1:
+                    x = block.forward_incremental(
+                        cache,
+                        x,
+                        pos,
+                        query_input=pos_embs[pos:pos + 1],
+                        cached=True)
+                else:
+                    x = block.forward_incremental(cache, x, pos,
+                                                  cached=(i == 0))
+            state['outputs'][pos] = self.norm(x)
+            state['num_done'] += 1
+        return state['outputs'][natural_col]
+
     def nll(self, logits, data):
         """Calculates -log p(data), given logits (the conditionals).
 
@@ -589,12 +764,15 @@ class Transformer(nn.Module):
 
         Args:
           idx: int, in natural (table) ordering.
-          logits: [batch size, ncols+1, d_model].
+          logits: [batch size, ncols+1, d_model], or [batch size, d_model]
+            for column idx only (see forward_incremental()).
 
         Returns:
           logits_for_col: [batch size, domain size for column idx].
         """
         embed = self.embeddings[idx]
+        if logits.dim() == 2:
+            return torch.matmul(logits, embed.weight.t())
         return torch.matmul(logits[:, idx, :], embed.weight.t())
 
 
@@ -649,3 +827,23 @@ if __name__ == '__main__':
             assert ok
 
         print('[Transformer] Passes autoregressive-ness check!')
+
+        # Incremental decoding == full forward, column by column.
+        model.eval()
+        with torch.no_grad():
+            inp = torch.randint(vocab, (bs, num_cols))
+            full = model(inp)
+            d = model.d_model
+            x = torch.zeros(1, (num_cols + 1) * d)
+            model.EncodeInput(None, natural_col=-1, out=x[:, :d])
+            state = model.init_incremental(x)
+            for nat_idx in ordering:
+                out = model.forward_incremental(state, nat_idx)
+                assert torch.allclose(out, full[:, nat_idx], atol=1e-5), (
+                    nat_idx, (out - full[:, nat_idx]).abs().max())
+                delta = torch.zeros(bs, d)
+                model.EncodeInput(inp[:, nat_idx:nat_idx + 1],
+                                  natural_col=nat_idx,
+                                  out=delta)
+                model.update_incremental(state, delta, nat_idx)
+        print('[Transformer] Passes incremental forward check!')